@@ -0,0 +1,128 @@
+import argparse
+import json
+import cv2
+import numpy
+
+UNIDENTIFIED = 'Unidentified'
+
+# quantized BGR color -> car lookup table, classifies a whole region of interest in one vectorized vote
+# regardless of how many cars are in the fleet
+class ColorLUT:
+    def __init__(self, table, car_ids, bits=6):
+        self.table = table
+        self.car_ids = list(car_ids)
+        self.bits = bits
+        self.shift = 8 - bits
+
+    # build the table from each Vehicle's color, a bin belongs to a car when its centre is inside the car's
+    # +/- tolerance window, and to the nearest car when several windows contain it
+    @classmethod
+    def from_vehicles(cls, cars, tolerance=5, bits=6):
+        car_ids = list(cars)
+        levels = 1 << bits
+        width = 1 << (8 - bits)
+        centers = numpy.arange(levels) * width + (width - 1) / 2
+
+        # Vehicle.color is stored RGB, frames are BGR
+        colors = numpy.array([cars[car_id].color[::-1] for car_id in car_ids], dtype=numpy.float64).reshape(-1, 3, 1)
+        distance = numpy.abs(centers - colors)
+        inside = distance <= tolerance
+
+        # combine the per-channel tests into (cars, b, g, r) grids
+        matches = inside[:, 0, :, None, None] & inside[:, 1, None, :, None] & inside[:, 2, None, None, :]
+        distances = distance[:, 0, :, None, None] + distance[:, 1, None, :, None] + distance[:, 2, None, None, :]
+        distances = numpy.where(matches, distances, numpy.inf).reshape(len(car_ids), -1)
+
+        table = numpy.zeros(levels ** 3, dtype=numpy.uint8)
+        if len(car_ids) > 0:
+            matched = numpy.isfinite(distances).any(axis=0)
+            table[matched] = distances[:, matched].argmin(axis=0) + 1
+        return cls(table, car_ids, bits)
+
+    # build the table from labelled sample regions, samples are (frame, [x, y, w, h], car_id) tuples and
+    # background frames show the empty intersection, a bin is given to a car when it makes up at least
+    # min_share of that car's pixels and is dominance times more common there than for any other car or the background
+    @classmethod
+    def calibrate(cls, samples, background=(), bits=6, min_share=0.001, dominance=4.0):
+        car_ids = []
+        histograms = []
+        lut = cls(None, [], bits)
+
+        for frame, contour, car_id in samples:
+            if car_id not in car_ids:
+                car_ids.append(car_id)
+                histograms.append(numpy.zeros(1 << (3 * bits), dtype=numpy.float64))
+            roi = frame[contour[1]: contour[1] + contour[3], contour[0]: contour[0] + contour[2]]
+            histograms[car_ids.index(car_id)] += lut.histogram(roi)
+
+        background_histogram = numpy.zeros(1 << (3 * bits), dtype=numpy.float64)
+        for frame in background:
+            background_histogram += lut.histogram(frame)
+
+        table = numpy.zeros(1 << (3 * bits), dtype=numpy.uint8)
+        if len(car_ids) == 0:
+            return cls(table, car_ids, bits)
+
+        shares = numpy.array([histogram / max(histogram.sum(), 1) for histogram in histograms])
+        background_share = background_histogram / max(background_histogram.sum(), 1)
+
+        best = shares.argmax(axis=0)
+        best_share = shares.max(axis=0)
+        others = shares.copy()
+        others[best, numpy.arange(others.shape[1])] = 0
+        rival_share = numpy.maximum(others.max(axis=0), background_share)
+
+        assigned = (best_share >= min_share) & (best_share >= dominance * rival_share)
+        table[assigned] = best[assigned] + 1
+        return cls(table, car_ids, bits)
+
+    @classmethod
+    def load(cls, path):
+        data = numpy.load(path, allow_pickle=False)
+        return cls(data['table'], [str(car_id) for car_id in data['car_ids']], int(data['bits']))
+
+    def save(self, path):
+        numpy.savez(path, table=self.table, car_ids=numpy.array(self.car_ids), bits=self.bits)
+
+    # map each BGR pixel to its bin in the table
+    def bin_index(self, image):
+        quantized = (image >> self.shift).astype(numpy.uint32)
+        return (quantized[..., 0] << (2 * self.bits)) | (quantized[..., 1] << self.bits) | quantized[..., 2]
+
+    def histogram(self, image):
+        return numpy.bincount(self.bin_index(image).ravel(), minlength=1 << (3 * self.bits))
+
+    # return the car with the most matching pixels in the region, or 'Unidentified' if fewer than min_pixels match
+    def classify(self, roi, min_pixels=1):
+        if roi.size == 0:
+            return UNIDENTIFIED
+        votes = numpy.bincount(self.table[self.bin_index(roi)].ravel(), minlength=len(self.car_ids) + 1)
+        votes[0] = 0
+        winner = votes.argmax()
+        if votes[winner] < min_pixels:
+            return UNIDENTIFIED
+        return self.car_ids[winner - 1]
+
+# calibrate from a JSON list of {"frame": path, "car": id, "box": [x, y, w, h]} samples
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a vehicle color lookup table from labelled sample frames.')
+    parser.add_argument('samples', help='JSON file of {"frame", "car", "box"} entries')
+    parser.add_argument('output', help='where to write the table (.npz)')
+    parser.add_argument('--background', nargs='*', default=[], help='frames of the empty intersection')
+    parser.add_argument('--bits', type=int, default=6, help='bits kept per color channel')
+    args = parser.parse_args()
+
+    with open(args.samples) as samples_file:
+        entries = json.load(samples_file)
+
+    frames = {}
+    samples = []
+    for entry in entries:
+        if entry['frame'] not in frames:
+            frames[entry['frame']] = cv2.imread(entry['frame'])
+        samples.append((frames[entry['frame']], entry['box'], entry['car']))
+
+    lut = ColorLUT.calibrate(samples, background=[cv2.imread(path) for path in args.background], bits=args.bits)
+    lut.save(args.output)
+    for index, car_id in enumerate(lut.car_ids):
+        print(f'{car_id}: {numpy.count_nonzero(lut.table == index + 1)} color bins')
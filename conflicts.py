@@ -0,0 +1,139 @@
+import time
+import numpy
+from geometry import segments_intersect
+from queuing import LANE_MAPPINGS, LANE_LINE_MIDPOINTS
+
+# every (approach, turn) movement of a layout, in a fixed order
+def movements(lane_mappings=LANE_MAPPINGS):
+    return [(approach, turn) for approach in lane_mappings for turn in lane_mappings[approach]]
+
+# (movements, movements) matrix of which movements cannot share the intersection, a movement runs from the midpoint
+# of its approach's forward lane to the midpoint of its destination lane, two movements conflict when those paths
+# cross or end in the same lane, movements from the same approach never conflict since they queue in one lane
+def conflict_matrix(lane_mappings=LANE_MAPPINGS, midpoints=LANE_LINE_MIDPOINTS):
+    moves = movements(lane_mappings)
+    starts = numpy.array([midpoints[approach + '-forward'] for approach, _ in moves], dtype=numpy.int64)
+    ends = numpy.array([midpoints[lane_mappings[approach][turn]] for approach, turn in moves], dtype=numpy.int64)
+    destinations = numpy.array([lane_mappings[approach][turn] for approach, turn in moves])
+    approaches = numpy.array([approach for approach, _ in moves])
+
+    crossing = segments_intersect(starts[:, None], ends[:, None], starts[None, :], ends[None, :])
+    merging = destinations[:, None] == destinations[None, :]
+    same_approach = approaches[:, None] == approaches[None, :]
+    return (crossing | merging) & ~same_approach
+
+# (movements, crosswalks) matrix of which movements drive over which crosswalk, a movement crosses the crosswalk
+# of the approach it leaves and of the approach its destination lane belongs to
+def crosswalk_matrix(lane_mappings=LANE_MAPPINGS):
+    moves = movements(lane_mappings)
+    crosswalks = list(lane_mappings)
+    matrix = numpy.zeros((len(moves), len(crosswalks)), dtype=bool)
+    for index, (approach, turn) in enumerate(moves):
+        matrix[index, crosswalks.index(approach)] = True
+        matrix[index, crosswalks.index(lane_mappings[approach][turn].split('-')[0])] = True
+    return matrix
+
+# let every car waiting at a stop line into the intersection whose movement is compatible with the movements already
+# inside it, instead of one car at a time, cars are considered by how long they have waited plus compatibility_bonus
+# seconds for every other waiting car they could go alongside, so a larger bonus favours throughput over arrival
+# order, and a car that has waited max_wait seconds is served first and holds back anything that would cut in,
+# a released car the camera has lost counts as inside the intersection for at most max_crossing seconds after it
+# was last seen, so it cannot block the movements it conflicts with forever, a car still seen never expires,
+# however long a closed crosswalk holds it inside
+class ConflictScheduler:
+    def __init__(self, lane_mappings=LANE_MAPPINGS, midpoints=LANE_LINE_MIDPOINTS, compatibility_bonus=2.0, max_wait=30.0, max_crossing=10.0):
+        self.lane_mappings = lane_mappings
+        self.movements = movements(lane_mappings)
+        self.movement_index = {movement: index for index, movement in enumerate(self.movements)}
+        self.crosswalks = list(lane_mappings)
+        self.conflicts = conflict_matrix(lane_mappings, midpoints)
+        self.crosswalk_conflicts = crosswalk_matrix(lane_mappings)
+        self.compatibility_bonus = compatibility_bonus
+        self.max_wait = max_wait
+        self.max_crossing = max_crossing
+
+        # released cars still inside the intersection with their movement and when each was last seen,
+        # and when each waiting car reached its stop line
+        self.active = {}
+        self.last_seen = {}
+        self.arrivals = {}
+        self.expired = 0
+
+        self.released = 0
+        self.total_wait = 0.0
+        self.longest_wait = 0.0
+
+    def movement_of(self, car):
+        return self.movement_index[(car.lane.split('-')[0], car.direction)]
+
+    # ids of the cars allowed to drive through the intersection now, given every queued car, the ids of the ones
+    # waiting at their stop line and which crosswalks are closed
+    def release(self, cars, waiting, crossing_lanes, now=None):
+        now = time.monotonic() if now is None else now
+        present = {car.id: car for car in cars}
+        waiting = set(waiting)
+
+        # a car leaves the intersection when it reaches its destination lane, drops out of the queue
+        # or has gone unseen for longer than any car takes to cross
+        for car_id in list(self.active):
+            car = present.get(car_id)
+            if car is not None and car.is_visible:
+                self.last_seen[car_id] = now
+            expired = now - self.last_seen[car_id] >= self.max_crossing
+            if car is None or car.lane == car.stop_lane or expired:
+                del self.active[car_id]
+                del self.last_seen[car_id]
+                if expired and car is not None and car.lane != car.stop_lane:
+                    self.expired += 1
+        for car_id in list(self.arrivals):
+            if car_id not in waiting:
+                del self.arrivals[car_id]
+
+        candidates = []
+        for car in cars:
+            if car.id not in waiting or car.id in self.active:
+                continue
+            self.arrivals.setdefault(car.id, now)
+            candidates.append(car)
+        if len(candidates) == 0:
+            return set(self.active)
+
+        closed = numpy.array([crossing_lanes.get(crosswalk, False) for crosswalk in self.crosswalks])
+        candidate_movements = numpy.array([self.movement_of(car) for car in candidates])
+        waited = numpy.array([now - self.arrivals[car.id] for car in candidates])
+        compatible = (~self.conflicts[candidate_movements][:, candidate_movements]).sum(axis=1) - 1
+        starving = waited >= self.max_wait
+        score = waited + self.compatibility_bonus * compatible
+        order = numpy.lexsort((-score, ~starving))
+
+        blocked = numpy.zeros(len(self.movements), dtype=bool)
+        for movement in self.active.values():
+            blocked |= self.conflicts[movement]
+
+        for index in order:
+            car = candidates[index]
+            movement = candidate_movements[index]
+            if blocked[movement] or (self.crosswalk_conflicts[movement] & closed).any():
+                # keep the next gap for a car that has waited too long
+                if starving[index]:
+                    blocked |= self.conflicts[movement]
+                continue
+            self.active[car.id] = movement
+            self.last_seen[car.id] = now
+            blocked |= self.conflicts[movement]
+            self.released += 1
+            self.total_wait += float(waited[index])
+            self.longest_wait = max(self.longest_wait, float(waited[index]))
+            del self.arrivals[car.id]
+
+        return set(self.active)
+
+    def stats(self):
+        return {
+            'released': self.released,
+            'mean_wait_s': self.total_wait / self.released if self.released > 0 else 0.0,
+            'max_wait_s': self.longest_wait,
+            'expired': self.expired,
+            'in_intersection': len(self.active),
+            'waiting': len(self.arrivals)
+        }
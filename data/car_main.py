@@ -5,26 +5,26 @@ https://github.com/sunfounder/pico_4wd_car/tree/v2.0
 
 Pico onboard LED status:
     - off: not working
-    - always on: working
+    - always on: working, a host is connected
+    - slow blink (0.5 s): waiting for a host to connect
     - blink: error
 
 *****************************************************************************************'''
 import time
 import sys
+import uasyncio as asyncio
 import motors as car
 import sonar as sonar
 import lights as lights
 from speed import Speed
 from grayscale import Grayscale
-from ws import WS_Server
+from ws import WS_Server, logger
 from machine import Pin
 
 print("Running...\n")
 
-LOG_FILE = "log.txt"
-
-with open(LOG_FILE, "w") as log_f:
-    log_f.write("")
+# start a fresh log, the previous run's stays in log.txt.1
+logger.rotate()
 
 onboard_led = Pin(25, Pin.OUT)
 
@@ -39,6 +39,8 @@ GRAYSCALE_CLIFF_REFERENCE_DEFAULT = 2000
 
 NORMAL_SCAN_ANGLE = 180
 NORMAL_SCAN_STEP = 5
+SONAR_SETTLE_MS = 40 # servo travel before an echo at the new angle is trusted
+SONAR_STEP_MS = 5 # how often the sonar task advances the scan
 
 signal_on_color = [80, 30, 0]
 brake_on_color = [255, 0, 0] 
@@ -68,20 +70,59 @@ brake_light_brightness = 255 # 0 ~ 255
 brake_light_brightness_flag = -1 # -1 or 1
 
 sonar_on = True
-sonar_angle = 0
-sonar_distance = 0
+
+# sweeps the sonar one step per call so nothing waits on the servo, the newest distance at every angle of the
+# sweep is kept in `table` and the newest reading overall in `angle` and `distance`
+# SET_ANGLE: point the servo, SETTLE: wait SONAR_SETTLE_MS, MEASURE: one echo, ADVANCE: next angle, back and forth
+class SonarScanner():
+    SET_ANGLE = 0
+    SETTLE = 1
+    MEASURE = 2
+    ADVANCE = 3
+
+    def __init__(self, scan_angle, scan_step, settle_ms=SONAR_SETTLE_MS):
+        half = scan_angle // 2
+        self.angles = list(range(-half, half + 1, scan_step)) if scan_angle > 0 else [0]
+        self.settle_ms = settle_ms
+        self.table = [None] * len(self.angles)
+        self.index = len(self.angles) // 2
+        self.direction = 1
+        self.state = self.SET_ANGLE
+        self.set_time = 0
+        self.angle = 0
+        self.distance = 0
+
+    def step(self):
+        if self.state == self.SET_ANGLE:
+            sonar.servo.set_angle(self.angles[self.index])
+            self.set_time = time.ticks_ms()
+            self.state = self.SETTLE
+        elif self.state == self.SETTLE:
+            if time.ticks_diff(time.ticks_ms(), self.set_time) >= self.settle_ms:
+                self.state = self.MEASURE
+        elif self.state == self.MEASURE:
+            self.angle = self.angles[self.index]
+            self.distance = sonar.us.get_distance()
+            self.table[self.index] = self.distance
+            self.state = self.ADVANCE
+        else:
+            if len(self.angles) > 1:
+                if not 0 <= self.index + self.direction < len(self.angles):
+                    self.direction = -self.direction
+                self.index += self.direction
+            # a single angle needs no servo move, measure again
+            self.state = self.SET_ANGLE if len(self.angles) > 1 else self.MEASURE
 
 '''------------ Instantiate -------------'''
 try:
     speed = Speed(8, 9)
     grayscale = Grayscale(26, 27, 28)
     ws = WS_Server(name=NAME, mode=WIFI_MODE, ssid=SSID, password=PASSWORD)
+    sonar_scanner = SonarScanner(NORMAL_SCAN_ANGLE if sonar_on else 0, NORMAL_SCAN_STEP)
 except Exception as e:
     onboard_led.off()
     sys.print_exception(e)
-    with open(LOG_FILE, "a") as log_f:
-        log_f.write('\n> ')
-        sys.print_exception(e, log_f)
+    logger.exception(e)
     sys.exit(1) # if ws init failed, exit
 
 def signal_lights_handler():
@@ -131,15 +172,8 @@ def bottom_lights_handler():
 
 def on_receive(data):
     global led_status, led_theme_code, led_theme_sum, lights_brightness
-    global sonar_on, sonar_angle, sonar_distance
-    
-    if sonar_on:
-        sonar.set_sonar_scan_config(NORMAL_SCAN_ANGLE, NORMAL_SCAN_STEP)
-        sonar_angle, sonar_distance, _ = sonar.sonar_scan()
-    else:
-        sonar_angle = 0
-        sonar_distance = sonar.get_distance_at(sonar_angle)
-    
+
+    # actuate first, the sonar is sampled in the background and only its cached readings are sent
     if 'motors' in data.keys():
         car.set_motors_power(data['motors'])
     
@@ -150,36 +184,44 @@ def on_receive(data):
     # Speed mileage
     ws.send_dict['C'] = speed.get_mileage() # unit: meter
     # # sonar and distance
-    ws.send_dict['D'] = [sonar_angle, sonar_distance]
-    ws.send_dict['E'] = sonar_distance
+    ws.send_dict['D'] = [sonar_scanner.angle, sonar_scanner.distance]
+    ws.send_dict['E'] = sonar_scanner.distance
     
     bottom_lights_handler()
     signal_lights_handler()
     brake_lights_handler()
 
+# stop the car whenever the host is gone, next to the server's own tasks
+async def disconnect_watchdog():
+    while True:
+        if not ws.is_connected():
+            car.move('stop', 0)
+        await asyncio.sleep(0.05)
+
+async def sonar_sampler():
+    while True:
+        sonar_scanner.step()
+        await asyncio.sleep(SONAR_STEP_MS / 1000)
+
 def main():
     sonar.servo.set_angle(0)
     car.move('stop')
     ws.on_receive = on_receive
     if ws.start():
         onboard_led.on()
-        while True:
-            if not ws.is_connected():
-                car.move('stop', 0)
-            ws.loop()
+        ws.run(disconnect_watchdog(), sonar_sampler(), logger.flusher())
 
 if __name__ == "__main__":
     try:
         main()
     except Exception as e:
         sys.print_exception(e)
-        with open(LOG_FILE, "a") as log_f:
-            log_f.write('\n> ')
-            sys.print_exception(e, log_f)
+        logger.exception(e)
     finally:
         car.move("stop")
         lights.set_off()
         ws.set("RESET", timeout=2500)
+        logger.flush()
         while True: # pico onboard led blinking indicates error
             time.sleep(0.25)
             onboard_led.off()
@@ -1,27 +1,124 @@
-from machine import UART
 import time
 import json
+import protocol
+from ring_log import RingLog
+
+try:
+    from machine import UART, Pin
+except ImportError:
+    # off the Pico, e.g. on a Linux host, talk to a simulated ESP8266 bridge instead
+    from mock_uart import UART, Pin
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
-from machine import Pin
 onboard_led_ws = Pin(25, Pin.OUT)
 
+# MicroPython's millisecond clock, and the same on CPython
+if hasattr(time, 'ticks_ms'):
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+    sleep_ms = time.sleep_ms
+else:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(end, start):
+        return end - start
+
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
+
 "custom Exception"
 class TimeoutError(Exception):
     pass
 
 LOG_FILE = "log.txt"
 
-def log(msg):
-    with open(LOG_FILE, "a") as log_f:
-        log_f.write(f'\n> {msg}')
-        time.sleep(0.01)
+# shared with car_main, entries stay in memory until a batch is written, so logging in retry paths costs nothing
+logger = RingLog(LOG_FILE)
 
+# non-blocking line framing over the UART, poll() takes whatever bytes are waiting and returns every line
+# completed so far, a partial line stays buffered until its newline arrives
+class LineReader():
+    # a line longer than this never ends, drop it
+    MAX_LINE = 2048
+
+    def __init__(self, uart):
+        self.uart = uart
+        self.buffer = b''
+        # complete lines not handed out yet by readline()
+        self.lines = []
+
+    def poll(self):
+        waiting = self.uart.any()
+        if waiting > 0:
+            data = self.uart.read(waiting)
+            if data:
+                self.buffer += data
+
+        lines = self.lines
+        self.lines = []
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end < 0:
+                break
+            line = self.decode(self.buffer[start:end])
+            if line != None:
+                lines.append(line)
+            start = end + 1
+        # one copy per poll, not per line
+        if start > 0:
+            self.buffer = self.buffer[start:]
+        if len(self.buffer) > self.MAX_LINE:
+            logger.warning("line overflow: %d bytes" % len(self.buffer))
+            self.buffer = b''
+            lines.append("GARBLED")
+        return lines
+
+    # the next complete line, or None
+    def readline(self):
+        if len(self.lines) == 0:
+            self.lines = self.poll()
+        if len(self.lines) == 0:
+            return None
+        return self.lines.pop(0)
+
+    # text of one line, "GARBLED" for a line the bridge mangled, None for lines to skip
+    def decode(self, buf):
+        garbled = False
+        if len(buf) > 0 and (buf[0] < 0x31 or buf[0] > 0xfe):
+            buf = buf[1:]
+            garbled = True
+        if buf.endswith(b'\r'):
+            buf = buf[:-1]
+        if len(buf) == 0:
+            return "GARBLED" if garbled else None
+        try:
+            buf = buf.decode()
+        except UnicodeError:
+            logger.warning("bufxx: %s" % buf)
+            return "GARBLED"
+        # the bridge's own debug output
+        if buf.startswith("[DEBUG] "):
+            return None
+        return buf
+
+# the car's websocket server, reached through the ESP8266 bridge on the UART, run() handles commands, periodic
+# telemetry and the status LED as concurrent tasks on the cooperative scheduler, loop() is a single
+# non-blocking pass for callers that keep their own loop
 class WS_Server():
     WS_TIMEOUT = 3000 # ms
     SEND_INTERVAL = 100 # ms
-    
+    POLL_INTERVAL = 1 # ms
+    LED_INTERVAL = 100 # ms, blinking while waiting on the bridge
+
     send_dict = {
         'Name': '',
+        'P': protocol.VERSION, # binary protocol version this car can switch to
         }
 
     def __init__(self, name=None, ssid=None, password='', mode=None, port=8765):
@@ -32,44 +129,32 @@ class WS_Server():
         self.password = password
         self.mode = mode.lower()
         self.port = port
-        # self.uart = UART(1, 115200, timeout=100, timeout_char=10)
-        self.uart = UART(1, 115200, timeout=10, timeout_char=5)
+        # reads never wait, LineReader only asks for the bytes already received
+        self.uart = UART(1, 115200, timeout=0, timeout_char=0)
+        self.reader = LineReader(self.uart)
 
         self.listen_s = None
         self.client_s = None
         self.ws = None
         self.wlan = None
         self._is_connected = False
-        # self.last_send_time = 0
+        self.last_send_time = 0
+        self.last_led_time = 0
+        self.binary = False # switched on when the host sends a binary frame
+        self.sequence = 0
 
         self.send_dict["Name"] = self.name
         print('reset ESP8266 module ...')
         esp8266_version = self.set("RESET", timeout=2500)
         print(f'ESP8266 module firmware version {esp8266_version}')
 
+    # the next complete line, or None when no full line has arrived, block=True waits for one
     def read(self, block=False):
-        buf = ""
-        while True: 
-            buf = self.uart.readline()
-            if buf == None:
-                if block:
-                    time.sleep_ms(1)
-                    continue
-                else:
-                    return None
-
-            if buf[0] < 0x31 or buf[0] > 0xfe:
-                buf = buf[1:]
-                log("bufxx: %s" % buf)
-                if buf == '':
-                    buf = "GARBLED" # Garbled characters
-                    return buf
-                     
-            buf = buf.decode().replace("\r\n", "")
-            if buf.startswith("[DEBUG] "):
-                buf = buf.replace("[DEBUG]", "[ESP8266]")
-            else:
-                return buf
+        while True:
+            result = self.reader.readline()
+            if result != None or not block:
+                return result
+            sleep_ms(self.POLL_INTERVAL)
 
     def write(self, value):
         value = "%s\n" % value
@@ -77,91 +162,68 @@ class WS_Server():
         self.uart.write(value)
 
     def send_data(self):
-        data = json.dumps(self.send_dict)
+        if self.binary:
+            sonar = self.send_dict.get('D', [0, 0])
+            frame = protocol.pack_telemetry(self.sequence, self.send_dict.get('A', [0, 0, 0]), self.send_dict.get('B', 0),
+                                            self.send_dict.get('C', 0), sonar[0], sonar[1])
+            self.sequence = (self.sequence + 1) & 0xFFFF
+            data = protocol.encode_text(frame)
+        else:
+            data = json.dumps(self.send_dict)
         self._command("WS", data)
+        self.last_send_time = ticks_ms()
 
     def _command(self, mode, command, value=None):
         command += str(value) if value != None else ""
         command = "%s+%s" % (mode, command)
         self.write(command)
 
+    # onboard LED flash, paced by the clock instead of sleeping between polls
+    def blink(self):
+        if ticks_diff(ticks_ms(), self.last_led_time) >= self.LED_INTERVAL:
+            onboard_led_ws.value(not onboard_led_ws.value())
+            self.last_led_time = ticks_ms()
+
     def set(self, command, value=None, timeout=None):
-        flag = 0
         retry_count = 0
         retry_max_count = 3
-        t_s = 0
-
-        # retry function
-        def retry():
-            nonlocal  t_s, retry_count
-            self._command("SET", command, value)
-            t_s = time.ticks_ms()
-            retry_count = retry_count + 1
 
         # send command
         self._command("SET", command, value)
         # get start time
-        t_s = time.ticks_ms()
+        t_s = ticks_ms()
 
         while True:
-            # onboard LED flash
-            if flag == 0:
-                onboard_led_ws.on()
-                flag = 1
-                time.sleep(0.1)
-            else:
-                onboard_led_ws.off()
-                flag = 0
-                time.sleep(0.1)
+            self.blink()
 
             # Timeout handle
-            if timeout != None:
-                if(time.ticks_ms() - t_s > timeout):
-                    if retry_count < retry_max_count:
-                        log(f"TimeoutError. retry {retry_count} ...     ")
-                        retry()
-                        continue
-                    raise TimeoutError('Set timeout %s ms'%timeout)
-
-            # UnicodeError
-            try:
-                result = self.read(block=False)
-            except UnicodeError:
+            if timeout != None and ticks_diff(ticks_ms(), t_s) > timeout:
                 if retry_count < retry_max_count:
-                    log(f"UnicodeError retry {retry_count} ...")
-                    retry()
+                    logger.warning(f"TimeoutError. retry {retry_count} ...")
+                    self._command("SET", command, value)
+                    t_s = ticks_ms()
+                    retry_count = retry_count + 1
                     continue
-                log("UnicodeError")
-            
-            # result
+                raise TimeoutError('Set timeout %s ms'%timeout)
+
+            result = self.read(block=False)
             if result == None:
+                sleep_ms(self.POLL_INTERVAL)
                 continue
-            elif result.startswith("[ERROR]"):
-                if retry_count < retry_max_count:
-                    log(f"{result} retry {retry_count} ...")
-                    retry()
-                    continue
-                log("result == [ERROR]")
-                
-            elif result == 'GARBLED':
+            elif result.startswith("[OK]"):
+                return result[4:].strip(" ")
+            elif result.startswith("[ERROR]") or result == 'GARBLED':
                 if retry_count < retry_max_count:
-                    log(f"result GARBLED retry {retry_count} ...")
-                    retry()
+                    logger.warning(f"{result} retry {retry_count} ...")
+                    self._command("SET", command, value)
+                    t_s = ticks_ms()
+                    retry_count = retry_count + 1
                     continue
-                log("result GARBLED ")
-
-            elif result.startswith("[OK]"):
-                result = result[4:]
-                result = result.strip(" ")
-                break
-            else:
-                continue
-
-        return result
+                logger.warning(f"{result} after {retry_count} retries")
 
     def _get(self, command):
         self._command("GET", command)
-        result = self.read()
+        result = self.read(block=True)
         return result
 
     def start(self):
@@ -175,9 +237,10 @@ class WS_Server():
             self.set("PORT", self.port, timeout=self.WS_TIMEOUT)
         except TimeoutError as e:
             print(e)
+            logger.error(str(e))
             print("Configuring WiFi Timeout.Please check whether the ESP8266 module is working.")
             return False
-        
+
         try:
             if self.mode == "sta":
                 print("Connecting to %s ... "%self.ssid)
@@ -193,42 +256,93 @@ class WS_Server():
 
     def is_connected(self):
         return self._is_connected
-        
+
     def on_receive(self, data):
         pass
-    
-    def is_valid_json(self, data):
-        try:
-            json.loads(data)
-        except ValueError:
-            return False
-        return True
-    
-    def loop(self):
-        receive = self.read()
-            
-        if receive == None:
-            self.send_data()
-            return
-        elif receive.startswith("[CONNECTED]"):
+
+    # act on one line from the bridge, returns True when it should be answered with telemetry
+    def handle(self, receive):
+        if receive.startswith("[CONNECTED]"):
             self._is_connected = True
             print("Connected from %s" % receive.split(" ")[1])
-            self.send_data()
+            return True
         elif receive.startswith("[DISCONNECTED]"):
             self._is_connected = False
+            self.binary = False
             print("Disconnected from %s" % receive.split(" ")[1])
         elif receive.startswith("[APPSTOP]"):
             self._is_connected = False
-        else:
+            self.binary = False
+        elif receive.startswith("["):
+            # bridge status lines such as [OK] or [ERROR] answer SET commands
+            pass
+        elif protocol.is_binary(receive):
             try:
-                if self.is_valid_json(receive):
-                    data = json.loads(receive)
-                    if isinstance(data, str):
-                        data = json.loads(data)
-                    self._is_connected = True
-                    self.on_receive(data)
-                    self.send_data()
-                else:
-                    print("Invalid JSON data:", receive)
+                _, _, _, data = protocol.unpack(protocol.decode_text(receive))
             except ValueError as e:
-                print("JSON parsing data:", str(e))
+                print("Binary frame error:", str(e))
+                return False
+            self.binary = True
+            self._is_connected = True
+            self.on_receive(data)
+            return True
+        else:
+            # parse once, a failed parse is the invalid JSON case
+            try:
+                data = json.loads(receive)
+                if isinstance(data, str):
+                    data = json.loads(data)
+            except ValueError:
+                print("Invalid JSON data:", receive)
+                return False
+            self._is_connected = True
+            self.on_receive(data)
+            return True
+        return False
+
+    # handle every line that has arrived, commands that arrived together are all applied and answered
+    # with one telemetry message carrying the newest state
+    def poll(self):
+        reply = False
+        for receive in self.reader.poll():
+            if self.handle(receive):
+                reply = True
+        if reply:
+            self.send_data()
+        return reply
+
+    def send_due(self):
+        return self._is_connected and ticks_diff(ticks_ms(), self.last_send_time) >= self.SEND_INTERVAL
+
+    # one non-blocking pass: answer whatever arrived, otherwise keep the telemetry going every SEND_INTERVAL
+    def loop(self):
+        if not self.poll() and self.send_due():
+            self.send_data()
+
+    async def _receiver(self):
+        while True:
+            self.poll()
+            await asyncio.sleep(self.POLL_INTERVAL / 1000)
+
+    async def _sender(self):
+        while True:
+            if self.send_due():
+                self.send_data()
+            wait = self.SEND_INTERVAL - ticks_diff(ticks_ms(), self.last_send_time)
+            await asyncio.sleep(max(wait, self.POLL_INTERVAL) / 1000)
+
+    # onboard LED: on while a host is connected, slow blink while waiting for one
+    async def _status_led(self):
+        while True:
+            if self._is_connected:
+                onboard_led_ws.on()
+            else:
+                onboard_led_ws.value(not onboard_led_ws.value())
+            await asyncio.sleep(0.5)
+
+    async def serve(self, *tasks):
+        await asyncio.gather(self._receiver(), self._sender(), self._status_led(), *tasks)
+
+    # run the server's tasks and any other coroutines of the car on the cooperative scheduler, never returns
+    def run(self, *tasks):
+        asyncio.run(self.serve(*tasks))
@@ -0,0 +1,135 @@
+'''*****************************************************************************************
+Stand-ins for machine.UART and machine.Pin so ws.py (car_ws.py) runs on a Linux host.
+The UART plays the ESP8266 bridge: SET commands are answered with [OK] after LATENCY_MS,
+WS lines written by the car are recorded in `sent`, and inject() delivers a line from the
+host, e.g. '[CONNECTED] 192.168.4.2' or a JSON or binary command.
+
+Not needed on the Pico. Run it from this folder with the repository root on the path to
+time the car-side server against it:
+
+    PYTHONPATH=.. python3 mock_uart.py
+*****************************************************************************************'''
+import time
+
+# what the bridge answers to each SET command, anything else gets an empty [OK]
+SET_REPLIES = {
+    'RESET': '1.2.0',
+    'START': '192.168.4.1',
+}
+
+def now_ms():
+    return time.monotonic() * 1000
+
+class Pin():
+    OUT = 1
+    IN = 0
+
+    def __init__(self, id, mode=OUT):
+        self.id = id
+        self._value = 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def toggle(self):
+        self._value = 1 - self._value
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+class UART():
+    LATENCY_MS = 2
+
+    def __init__(self, id, baudrate=115200, timeout=0, timeout_char=0):
+        self.id = id
+        self.timeout = timeout
+        # (ms when it reaches the car, bytes) not yet read by the car, and (ms, line) the car sent to the host
+        self.pending = []
+        self.buffer = b''
+        self.sent = []
+        self.written = []
+
+    # deliver a line from the bridge after LATENCY_MS
+    def inject(self, line, latency_ms=None):
+        latency_ms = self.LATENCY_MS if latency_ms is None else latency_ms
+        if isinstance(line, str):
+            line = line.encode()
+        self.pending.append((now_ms() + latency_ms, line + b'\r\n'))
+
+    def _arrived(self):
+        now = now_ms()
+        while len(self.pending) > 0 and self.pending[0][0] <= now:
+            self.buffer += self.pending.pop(0)[1]
+
+    def any(self):
+        self._arrived()
+        return len(self.buffer)
+
+    def read(self, nbytes=None):
+        self._arrived()
+        if len(self.buffer) == 0:
+            return None
+        nbytes = len(self.buffer) if nbytes is None else nbytes
+        data, self.buffer = self.buffer[:nbytes], self.buffer[nbytes:]
+        return data
+
+    # like the real UART, wait up to `timeout` ms for a line
+    def readline(self):
+        deadline = now_ms() + self.timeout
+        while True:
+            self._arrived()
+            end = self.buffer.find(b'\n')
+            if end >= 0:
+                line, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+                return line
+            if now_ms() >= deadline:
+                return None
+            time.sleep(0.0005)
+
+    def write(self, data):
+        for line in data.decode().split('\n'):
+            if line == '':
+                continue
+            self.written.append(line)
+            mode, _, command = line.partition('+')
+            if mode == 'SET':
+                name = next((name for name in SET_REPLIES if command.startswith(name)), None)
+                self.inject('[OK] %s' % SET_REPLIES.get(name, ''))
+            elif mode == 'WS':
+                self.sent.append((now_ms(), command))
+        return len(data)
+
+# setup time and command -> telemetry round trip of the car-side server against the mock bridge
+def benchmark(messages=200):
+    import json
+    import car_ws
+
+    start = now_ms()
+    ws = car_ws.WS_Server(name='mock-car', mode='ap', ssid='mock-car')
+    ws.start()
+    setup_ms = now_ms() - start
+
+    # from a command reaching the car to the first telemetry line after the car handled it
+    received = []
+    ws.on_receive = lambda data: received.append(now_ms())
+    uart = ws.uart
+    uart.inject('[CONNECTED] 192.168.4.2')
+    round_trips = []
+    for index in range(messages):
+        command_time = now_ms() + uart.LATENCY_MS
+        uart.inject(json.dumps({'motors': [50, 50, 50, 50]}))
+        while len(received) <= index or uart.sent[-1][0] < received[index]:
+            ws.loop()
+        round_trips.append(uart.sent[-1][0] - command_time)
+
+    round_trips.sort()
+    print('setup: %.1f ms' % setup_ms)
+    print('round trip: mean %.2f ms, p95 %.2f ms' % (sum(round_trips) / len(round_trips), round_trips[int(len(round_trips) * 0.95)]))
+
+if __name__ == '__main__':
+    benchmark()
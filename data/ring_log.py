@@ -0,0 +1,150 @@
+'''*****************************************************************************************
+In-memory ring-buffer logger for the car firmware (copy this file to the Pico next to ws.py).
+Runs on CPython and MicroPython.
+
+Logging only stores the message in a fixed-size ring, nothing touches the flash and nothing
+sleeps. The ring is written to the log file in one batch when an ERROR (or worse) is logged,
+when flush() or maybe_flush() finds flush_interval has passed, or from the flusher() task on
+the cooperative scheduler. When the ring fills up before a flush the oldest entries are
+overwritten and counted. The log file is rotated to <path>.1 once it would grow past max_size.
+*****************************************************************************************'''
+import sys
+import time
+
+try:
+    import uos as os
+except ImportError:
+    import os
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {
+    DEBUG: 'DEBUG',
+    INFO: 'INFO',
+    WARNING: 'WARNING',
+    ERROR: 'ERROR',
+}
+
+if hasattr(time, 'ticks_ms'):
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+else:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(end, start):
+        return end - start
+
+# traceback of an exception as text
+def format_exception(e):
+    if hasattr(sys, 'print_exception'):
+        import io
+        buf = io.StringIO()
+        sys.print_exception(e, buf)
+        return buf.getvalue()
+    import traceback
+    return ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+
+class RingLog():
+    def __init__(self, path='log.txt', capacity=64, level=INFO, flush_level=ERROR, flush_interval=5000, max_size=16 * 1024):
+        self.path = path
+        self.capacity = capacity
+        self.level = level
+        self.flush_level = flush_level
+        self.flush_interval = flush_interval # ms
+        self.max_size = max_size # bytes
+
+        # (ticks_ms, level, message) slots, the next slot to write and how many hold unwritten entries
+        self.entries = [None] * capacity
+        self.next = 0
+        self.count = 0
+        self.dropped = 0
+        self.last_flush = ticks_ms()
+
+    def log(self, level, msg):
+        if level < self.level:
+            return
+        self.entries[self.next] = (ticks_ms(), level, msg)
+        self.next = (self.next + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.dropped += 1
+        if level >= self.flush_level:
+            self.flush()
+
+    def debug(self, msg):
+        self.log(DEBUG, msg)
+
+    def info(self, msg):
+        self.log(INFO, msg)
+
+    def warning(self, msg):
+        self.log(WARNING, msg)
+
+    def error(self, msg):
+        self.log(ERROR, msg)
+
+    # log an exception with its traceback, which flushes at the default flush_level
+    def exception(self, e, level=ERROR):
+        self.log(level, format_exception(e).rstrip('\n'))
+
+    def size(self):
+        try:
+            return os.stat(self.path)[6]
+        except OSError:
+            return 0
+
+    # start a new log file, keeping the previous one as <path>.1
+    def rotate(self):
+        backup = self.path + '.1'
+        try:
+            os.remove(backup)
+        except OSError:
+            pass
+        try:
+            os.rename(self.path, backup)
+        except OSError:
+            pass
+
+    # write every buffered entry in one append, oldest first
+    def flush(self):
+        self.last_flush = ticks_ms()
+        if self.count == 0:
+            return
+        lines = []
+        if self.dropped > 0:
+            lines.append('\n> [WARNING] %d log entries dropped' % self.dropped)
+        start = (self.next - self.count) % self.capacity
+        for index in range(self.count):
+            slot = (start + index) % self.capacity
+            ticks, level, msg = self.entries[slot]
+            lines.append('\n> %d [%s] %s' % (ticks, LEVEL_NAMES.get(level, level), msg))
+            self.entries[slot] = None
+        self.count = 0
+        self.dropped = 0
+
+        text = ''.join(lines)
+        if self.size() + len(text) > self.max_size:
+            self.rotate()
+        with open(self.path, 'a') as log_f:
+            log_f.write(text)
+
+    # flush if flush_interval has passed since the last flush, for callers that run their own loop
+    def maybe_flush(self):
+        if ticks_diff(ticks_ms(), self.last_flush) >= self.flush_interval:
+            self.flush()
+
+    # flush every flush_interval on the cooperative scheduler
+    async def flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval / 1000)
+            self.maybe_flush()
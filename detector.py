@@ -0,0 +1,184 @@
+import os
+import shutil
+import sys
+import tempfile
+import cv2
+import numpy
+
+# detection settings shared by every backend, matching the original model.predict call
+CONFIDENCE = 0.5
+IOU_THRESHOLD = 0.7
+MAX_DETECTIONS = 6
+INPUT_SIZE = 640
+LETTERBOX_COLOR = (114, 114, 114)
+
+# offset added per class so a single NMS pass never suppresses boxes of different classes
+CLASS_OFFSET = 4096
+
+BACKENDS = ('ultralytics', 'onnx', 'openvino')
+DEFAULT_BACKEND = 'ultralytics'
+
+# number of cores this process may run on, used to size the CPU runtime's thread pool
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# export a .pt model to ONNX next to it, reusing an existing export unless the weights are newer,
+# a dynamic export accepts any batch size and is kept apart as <model>.dynamic.onnx, ultralytics always
+# writes <model>.onnx next to the weights it was given, so the export runs on a copy of the weights in a
+# scratch directory and only the finished file is moved into place, leaving the other export untouched
+def export_onnx(model_path, imgsz=INPUT_SIZE, dynamic=False):
+    onnx_path = os.path.splitext(model_path)[0] + ('.dynamic.onnx' if dynamic else '.onnx')
+    if os.path.exists(onnx_path) and os.path.getmtime(onnx_path) >= os.path.getmtime(model_path):
+        return onnx_path
+    from ultralytics import YOLO
+    print(f'Exporting "{model_path}" to ONNX ...')
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(model_path))) as export_dir:
+        weights = os.path.join(export_dir, os.path.basename(model_path))
+        shutil.copy2(model_path, weights)
+        exported = YOLO(weights).export(format='onnx', imgsz=imgsz, dynamic=dynamic, simplify=True)
+        os.replace(exported, onnx_path)
+    return onnx_path
+
+# resize an image to fit inside size x size keeping its aspect ratio, padding the rest
+def letterbox(image, size=INPUT_SIZE):
+    height, width = image.shape[:2]
+    scale = min(size / height, size / width)
+    new_width, new_height = int(round(width * scale)), int(round(height * scale))
+    pad_x = (size - new_width) / 2
+    pad_y = (size - new_height) / 2
+
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    if top or bottom or left or right:
+        image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+    return image, scale, (left, top)
+
+# run the original ultralytics model, on a GPU when device is a CUDA index
+class UltralyticsDetector:
+    def __init__(self, model_path, device=0):
+        from ultralytics import YOLO
+        self.model = YOLO(model_path)
+        self.device = device
+
+    def detect(self, frame):
+        result = self.model.predict(frame, max_det=MAX_DETECTIONS, verbose=False, device=self.device, conf=CONFIDENCE, iou=IOU_THRESHOLD, vid_stride=True)[0]
+        return result.boxes.data.detach().cpu().numpy()
+
+    # run the model once on a list of frames, returning one array of rows per frame
+    def detect_batch(self, frames):
+        results = self.model.predict(list(frames), max_det=MAX_DETECTIONS, verbose=False, device=self.device, conf=CONFIDENCE, iou=IOU_THRESHOLD)
+        return [result.boxes.data.detach().cpu().numpy() for result in results]
+
+# run an ONNX export of the model on the CPU through ONNX Runtime, returning the same rows as UltralyticsDetector
+class OnnxDetector:
+    def __init__(self, model_path, threads=None, providers=None, dynamic_batch=False):
+        import onnxruntime
+
+        if model_path.endswith('.pt'):
+            model_path = export_onnx(model_path, dynamic=dynamic_batch)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = threads if threads is not None else available_cores()
+        options.inter_op_num_threads = 1
+
+        if providers is None:
+            providers = ['CPUExecutionProvider']
+        available = onnxruntime.get_available_providers()
+        providers = [provider for provider in providers if provider in available] or ['CPUExecutionProvider']
+
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_size = self.session.get_inputs()[0].shape[2]
+        if not isinstance(self.input_size, int):
+            self.input_size = INPUT_SIZE
+        # a fixed batch dimension of 1 means batches are run one frame at a time
+        self.batch_size = self.session.get_inputs()[0].shape[0]
+        if not isinstance(self.batch_size, int):
+            self.batch_size = None
+
+    def preprocess(self, frame):
+        image, scale, padding = letterbox(frame, self.input_size)
+        blob = cv2.dnn.blobFromImage(image, scalefactor=1 / 255.0, swapRB=True)
+        return blob, scale, padding
+
+    # turn the raw (1, 4 + classes, anchors) output into NMS-filtered [x1, y1, x2, y2, confidence, class] rows
+    def postprocess(self, output, scale, padding, frame_shape):
+        predictions = output[0].T
+        class_scores = predictions[:, 4:]
+        classes = class_scores.argmax(axis=1)
+        confidences = class_scores[numpy.arange(len(classes)), classes]
+
+        keep = confidences >= CONFIDENCE
+        if not keep.any():
+            return numpy.zeros((0, 6), dtype=numpy.float32)
+        predictions, classes, confidences = predictions[keep], classes[keep], confidences[keep]
+
+        boxes = numpy.empty((len(predictions), 4), dtype=numpy.float32)
+        boxes[:, 0] = predictions[:, 0] - predictions[:, 2] / 2
+        boxes[:, 1] = predictions[:, 1] - predictions[:, 3] / 2
+        boxes[:, 2] = predictions[:, 0] + predictions[:, 2] / 2
+        boxes[:, 3] = predictions[:, 1] + predictions[:, 3] / 2
+
+        offset_boxes = boxes.copy()
+        offset_boxes[:, 0] += classes * CLASS_OFFSET
+        offset_boxes[:, 2] = predictions[:, 2]
+        offset_boxes[:, 3] = predictions[:, 3]
+        indices = cv2.dnn.NMSBoxes(offset_boxes.tolist(), confidences.tolist(), CONFIDENCE, IOU_THRESHOLD, top_k=MAX_DETECTIONS)
+        indices = numpy.array(indices, dtype=numpy.int64).reshape(-1)[:MAX_DETECTIONS]
+
+        # undo the letterbox so boxes are in the original frame's pixels
+        boxes = boxes[indices]
+        boxes[:, [0, 2]] = (boxes[:, [0, 2]] - padding[0]) / scale
+        boxes[:, [1, 3]] = (boxes[:, [1, 3]] - padding[1]) / scale
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, frame_shape[1])
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, frame_shape[0])
+
+        return numpy.column_stack((boxes, confidences[indices], classes[indices])).astype(numpy.float32)
+
+    def detect(self, frame):
+        blob, scale, padding = self.preprocess(frame)
+        output = self.session.run(None, {self.input_name: blob})[0]
+        return self.postprocess(output, scale, padding, frame.shape)
+
+    # run the model once on a list of frames when it takes dynamic batches, returning one array of rows per frame
+    def detect_batch(self, frames):
+        if self.batch_size is not None or len(frames) == 1:
+            return [self.detect(frame) for frame in frames]
+        prepared = [self.preprocess(frame) for frame in frames]
+        outputs = self.session.run(None, {self.input_name: numpy.concatenate([blob for blob, _, _ in prepared])})[0]
+        return [self.postprocess(output[None], scale, padding, frame.shape) for output, (_, scale, padding), frame in zip(outputs, prepared, frames)]
+
+# build the detector for a backend name, see BACKENDS
+def create_detector(backend, model_path, device=0, threads=None, dynamic_batch=False):
+    if backend == 'ultralytics':
+        return UltralyticsDetector(model_path, device=device)
+    elif backend == 'onnx':
+        return OnnxDetector(model_path, threads=threads, dynamic_batch=dynamic_batch)
+    elif backend == 'openvino':
+        return OnnxDetector(model_path, threads=threads, providers=['OpenVINOExecutionProvider', 'CPUExecutionProvider'], dynamic_batch=dynamic_batch)
+    raise ValueError(f'Unknown detector backend "{backend}", expected one of {BACKENDS}')
+
+# the model for a backend, behind the frame-skipping predictor when detect_every > 1 and the motion gate
+# when motion_gating is on, main.py and every supervised intersection build their detector here
+def build_detector(backend, model_path, device=0, threads=None, detect_every=1, redetect_confidence=0.6, motion_gating=True):
+    from kalman import PredictiveDetector
+    from motion_gate import GatedDetector
+
+    built = create_detector(backend, model_path, device=device, threads=threads)
+    if detect_every > 1:
+        built = PredictiveDetector(built, every=detect_every, min_confidence=redetect_confidence)
+    if motion_gating:
+        built = GatedDetector(built)
+    return built
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'export':
+        print('usage: python detector.py export <model.pt>')
+        sys.exit(1)
+    print(f'ONNX model written to {export_onnx(sys.argv[2])}')
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import random
+import struct
+import threading
+import time
+from collections import deque
+import websockets
+import protocol
+from metrics import metrics
+
+# copy a telemetry message's fields onto its Vehicle
+def apply_telemetry(car, data):
+    car.greyscale = data['A']
+    car.currentSpeed = data['B']
+    car.mileage = data['C']
+    car.sonar_angle = data['D'][0]
+    car.sonar_distance = data['D'][1]
+
+# connection state for one car's websocket
+class CarLink:
+    def __init__(self, uri):
+        self.uri = uri
+        self.car_key = None
+        self.connected = False
+        self.wake = None
+        self.last_sent = None
+        self.last_send_time = 0.0
+        self.changed_at = None
+        self.sent_at = None
+        self.reconnects = 0
+        self.websocket = None
+        self.closed = False
+
+        # switched on once the car advertises the binary protocol, reset on reconnect
+        self.binary = False
+        self.sequence = 0
+
+        # controller change -> command written to the socket, and command written -> next telemetry from the car
+        self.command_latencies = deque(maxlen=500)
+        self.round_trips = deque(maxlen=500)
+
+# manage every car's websocket from one asyncio event loop on a background thread, commands go out
+# as soon as the controller changes them and telemetry is handed to the control thread under a lock
+class FleetManager:
+    def __init__(self, cars, uris, keepalive_interval=0.1, backoff_initial=0.5, backoff_max=10.0, binary=True):
+        self.cars = cars
+        self.binary = binary
+        self.links = [CarLink(uri) for uri in uris]
+        self.keepalive_interval = keepalive_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self.lock = threading.Lock()
+        self.telemetry = {}
+        self.loop = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self._run(),))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.loop is not None:
+            for link in self.links:
+                if link.wake is not None:
+                    self.loop.call_soon_threadsafe(link.wake.set)
+
+    # connect to another car, before or after start
+    def add_link(self, uri):
+        link = CarLink(uri)
+        self.links.append(link)
+        if self.running:
+            asyncio.run_coroutine_threadsafe(self._connection(link), self.loop)
+        return link
+
+    # disconnect from a car for good, e.g. once it has driven on to another intersection
+    def remove_link(self, uri):
+        for link in self.links:
+            if link.uri == uri:
+                link.closed = True
+                self.links.remove(link)
+                if self.running and link.websocket is not None:
+                    asyncio.run_coroutine_threadsafe(link.websocket.close(), self.loop)
+                return link
+        return None
+
+    # control thread: copy the newest telemetry of every car onto its Vehicle
+    def apply_telemetry(self):
+        with self.lock:
+            telemetry = self.telemetry
+            self.telemetry = {}
+        for car_key in telemetry:
+            if car_key in self.cars:
+                apply_telemetry(self.cars[car_key], telemetry[car_key])
+
+    # control thread: wake the sender of every car whose motor speeds changed since its last command
+    def push_commands(self):
+        if not self.running:
+            return
+        now = time.perf_counter()
+        for link in self.links:
+            if link.car_key is None or link.wake is None or link.car_key not in self.cars:
+                continue
+            if self.cars[link.car_key].motor_speeds != link.last_sent and link.changed_at is None:
+                link.changed_at = now
+                self.loop.call_soon_threadsafe(link.wake.set)
+
+    # keep the loop alive while running, so links added later get connected on it too
+    async def _run(self):
+        connections = [asyncio.create_task(self._connection(link)) for link in self.links]
+        while self.running:
+            await asyncio.sleep(self.keepalive_interval)
+        await asyncio.gather(*connections)
+
+    # keep one car connected, reconnecting with exponential backoff and jitter
+    async def _connection(self, link):
+        link.wake = asyncio.Event()
+        backoff = self.backoff_initial
+        while self.running and not link.closed:
+            try:
+                async with websockets.connect(link.uri, open_timeout=5, ping_interval=None) as websocket:
+                    link.websocket = websocket
+                    link.connected = True
+                    backoff = self.backoff_initial
+                    print(f'Connection opened to {link.uri}')
+                    sender = asyncio.create_task(self._sender(link, websocket))
+                    try:
+                        async for message in websocket:
+                            # a malformed message is dropped, it must not end the connection
+                            try:
+                                self._on_message(link, message)
+                            except (ValueError, KeyError, TypeError, struct.error) as error:
+                                print(f'Dropped a malformed message from {link.uri}: {error!r}')
+                                metrics.increment('messages_dropped_total')
+                    finally:
+                        sender.cancel()
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as error:
+                print(f'Error occurred on {link.uri}: {error}')
+            except Exception as error:
+                print(f'Unexpected error on {link.uri}: {error!r}')
+            finally:
+                # every way out of the connection leads to a reconnect
+                if link.connected:
+                    print(f'Connection closed to {link.uri}')
+                link.connected = False
+                link.websocket = None
+                link.last_sent = None
+                link.binary = False
+
+            if self.running and not link.closed:
+                await asyncio.sleep(backoff * (0.5 + random.random()))
+                backoff = min(backoff * 2, self.backoff_max)
+                link.reconnects += 1
+
+    def _on_message(self, link, message):
+        metrics.increment('messages_received_total', labels={'format': 'binary' if protocol.is_binary(message) else 'json'})
+        if protocol.is_binary(message):
+            # binary telemetry carries no name, the car introduced itself in JSON first
+            _, _, _, data = protocol.unpack(protocol.decode_text(message))
+            if link.car_key is None:
+                return
+        else:
+            if 'pong' in message or message == 'A':
+                return
+            data = json.loads(message)
+            if link.car_key is None:
+                link.car_key = data['Name']
+                link.wake.set()
+            # the car speaks the binary protocol, answer in binary so it switches over too
+            if self.binary and data.get('P', 0) >= protocol.VERSION:
+                link.binary = True
+
+        if link.sent_at is not None:
+            link.round_trips.append(time.perf_counter() - link.sent_at)
+            link.sent_at = None
+
+        # the car's first messages only introduce it, telemetry fields follow once it handled a command
+        car = self.cars.get(link.car_key)
+        if car is None or not all(key in data for key in ('A', 'B', 'C', 'D')):
+            return
+        if car.telemetry is not None:
+            car.telemetry.append(data['A'], data['B'], data['C'], data['D'][0], data['D'][1])
+
+        with self.lock:
+            self.telemetry[link.car_key] = data
+
+    # send a car its motor speeds when they change, and repeat them every keepalive_interval so the car keeps receiving
+    async def _sender(self, link, websocket):
+        while self.running:
+            try:
+                await asyncio.wait_for(link.wake.wait(), self.keepalive_interval)
+            except asyncio.TimeoutError:
+                pass
+            link.wake.clear()
+            if link.car_key is None or link.car_key not in self.cars:
+                continue
+
+            motor_speeds = list(self.cars[link.car_key].motor_speeds)
+            now = time.perf_counter()
+            if motor_speeds == link.last_sent and now - link.last_send_time < self.keepalive_interval:
+                continue
+
+            start = time.perf_counter()
+            if link.binary:
+                await websocket.send(protocol.encode_text(protocol.pack_command(link.sequence, motor_speeds)))
+                link.sequence = (link.sequence + 1) & 0xFFFF
+            else:
+                await websocket.send(json.dumps({"motors": motor_speeds}))
+            link.last_send_time = time.perf_counter()
+            metrics.observe('websocket_send', link.last_send_time - start)
+            metrics.increment('commands_sent_total', labels={'car': link.car_key})
+            if link.sent_at is None:
+                link.sent_at = link.last_send_time
+            if link.changed_at is not None:
+                link.command_latencies.append(link.last_send_time - link.changed_at)
+                link.changed_at = None
+            link.last_sent = motor_speeds
+
+    def stats(self):
+        stats = {}
+        for link in self.links:
+            latencies = sorted(link.command_latencies)
+            round_trips = sorted(link.round_trips)
+            stats[link.car_key or link.uri] = {
+                'connected': link.connected,
+                'reconnects': link.reconnects,
+                'command_latency_ms_p50': latencies[len(latencies) // 2] * 1000 if len(latencies) > 0 else 0.0,
+                'command_latency_ms_p95': latencies[int(len(latencies) * 0.95)] * 1000 if len(latencies) > 0 else 0.0,
+                'round_trip_ms_p50': round_trips[len(round_trips) // 2] * 1000 if len(round_trips) > 0 else 0.0
+            }
+        return stats
+
+    def print_stats(self):
+        stats = self.stats()
+        for car_key in stats:
+            car_stats = stats[car_key]
+            print(f'{car_key}: command latency p50 {car_stats["command_latency_ms_p50"]:.2f} ms, p95 {car_stats["command_latency_ms_p95"]:.2f} ms, '
+                  f'round trip p50 {car_stats["round_trip_ms_p50"]:.1f} ms, {car_stats["reconnects"]} reconnects')
@@ -0,0 +1,59 @@
+import numpy
+
+# counter-clockwise test for arrays of points, the last axis holds (x, y)
+def ccw(a, b, c):
+    return (c[..., 1] - a[..., 1]) * (b[..., 0] - a[..., 0]) > (b[..., 1] - a[..., 1]) * (c[..., 0] - a[..., 0])
+
+# segment a-b crosses segment c-d, broadcast over any leading axes
+def segments_intersect(a, b, c, d):
+    return (ccw(a, c, d) != ccw(b, c, d)) & (ccw(a, b, c) != ccw(a, b, d))
+
+# the four edges of each [x, y, w, h] rectangle as an (n, 4, 2, 2) array of segments
+def rectangle_edges(contours):
+    contours = numpy.asarray(contours, dtype=numpy.int64).reshape(-1, 4)
+    x, y, w, h = contours[:, 0], contours[:, 1], contours[:, 2], contours[:, 3]
+    top_left = numpy.stack((x, y), axis=1)
+    top_right = numpy.stack((x + w, y), axis=1)
+    bottom_left = numpy.stack((x, y + h), axis=1)
+    bottom_right = numpy.stack((x + w, y + h), axis=1)
+    return numpy.stack((
+        numpy.stack((top_left, top_right), axis=1),
+        numpy.stack((top_left, bottom_left), axis=1),
+        numpy.stack((top_right, bottom_right), axis=1),
+        numpy.stack((bottom_left, bottom_right), axis=1)
+    ), axis=1)
+
+# a fixed set of named line segments, such as stop lines, held as arrays for batched tests
+class SegmentSet:
+    def __init__(self, segments):
+        self.keys = list(segments)
+        points = numpy.array([segments[key] for key in self.keys], dtype=numpy.int64).reshape(-1, 2, 2)
+        self.starts = points[:, 0]
+        self.ends = points[:, 1]
+
+    # (rectangles, segments) boolean matrix of which [x, y, w, h] rectangle's edges cross which segment
+    def touching(self, contours):
+        edges = rectangle_edges(contours)
+        edge_starts = edges[:, None, :, 0, :]
+        edge_ends = edges[:, None, :, 1, :]
+        starts = self.starts[None, :, None, :]
+        ends = self.ends[None, :, None, :]
+        return segments_intersect(starts, ends, edge_starts, edge_ends).any(axis=2)
+
+# convert [x, y, w, h] contours to [x1, y1, x2, y2] boxes
+def contours_to_boxes(contours):
+    boxes = numpy.asarray(contours, dtype=numpy.float64).reshape(-1, 4).copy()
+    boxes[:, 2:] += boxes[:, :2]
+    return boxes
+
+# (a, b) matrix of intersection over union between two arrays of [x1, y1, x2, y2] boxes
+def iou_matrix(a, b):
+    a = numpy.asarray(a, dtype=numpy.float64).reshape(-1, 4)
+    b = numpy.asarray(b, dtype=numpy.float64).reshape(-1, 4)
+    width = (numpy.minimum(a[:, None, 2], b[None, :, 2]) - numpy.maximum(a[:, None, 0], b[None, :, 0])).clip(0)
+    height = (numpy.minimum(a[:, None, 3], b[None, :, 3]) - numpy.maximum(a[:, None, 1], b[None, :, 1])).clip(0)
+    intersection = width * height
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return intersection / numpy.maximum(union, 1e-9)
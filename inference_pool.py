@@ -0,0 +1,162 @@
+import multiprocessing
+import queue
+import signal
+import time
+from multiprocessing import shared_memory
+import numpy
+from detector import create_detector, available_cores, MAX_DETECTIONS
+
+# arrays over the pool's shared memory: frame slots, up to MAX_DETECTIONS result rows per slot and the row count
+# of each slot, the memory objects must outlive the arrays
+def shared_arrays(frame_memory, result_memory, count_memory, slots, frame_shape):
+    frames = numpy.ndarray((slots,) + tuple(frame_shape), dtype=numpy.uint8, buffer=frame_memory.buf)
+    results = numpy.ndarray((slots, MAX_DETECTIONS, 6), dtype=numpy.float32, buffer=result_memory.buf)
+    counts = numpy.ndarray((slots,), dtype=numpy.int32, buffer=count_memory.buf)
+    return frames, results, counts
+
+# detector process: run the model on every slot it is handed and write the boxes next to it in shared memory
+def run_worker(names, slots, frame_shape, backend, model_path, device, threads, tasks, done):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    memories = [shared_memory.SharedMemory(name=name) for name in names]
+    frames, results, counts = shared_arrays(*memories, slots, frame_shape)
+    detector = create_detector(backend, model_path, device=device, threads=threads)
+    done.put(('ready', None, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, sequence = task
+        detections = detector.detect(frames[slot])[:MAX_DETECTIONS]
+        results[slot, :len(detections)] = detections
+        counts[slot] = len(detections)
+        done.put(('done', slot, sequence))
+
+    del frames, results, counts
+    for memory in memories:
+        memory.close()
+
+# run the model in several processes on frames shared through a ring of shared-memory slots, frames go in with
+# submit() and come back with their detections from next_result() in the order they were submitted,
+# only slot indices travel through the queues, never frames or boxes
+class InferencePool:
+    def __init__(self, backend, model_path, workers=None, slots=None, frame_shape=(640, 640, 3), device='cpu', threads=None):
+        self.workers = max(1, available_cores() // 2) if workers is None else workers
+        self.slots = 2 * self.workers if slots is None else max(slots, self.workers)
+        self.frame_shape = tuple(frame_shape)
+        threads = max(1, available_cores() // self.workers) if threads is None else threads
+
+        self.frame_memory = shared_memory.SharedMemory(create=True, size=self.slots * int(numpy.prod(self.frame_shape)))
+        self.result_memory = shared_memory.SharedMemory(create=True, size=self.slots * MAX_DETECTIONS * 6 * 4)
+        self.count_memory = shared_memory.SharedMemory(create=True, size=self.slots * 4)
+        names = (self.frame_memory.name, self.result_memory.name, self.count_memory.name)
+        self.frames, self.results, self.counts = shared_arrays(self.frame_memory, self.result_memory, self.count_memory, self.slots, self.frame_shape)
+
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.done = context.Queue()
+        self.processes = []
+        for index in range(self.workers):
+            process = context.Process(target=run_worker, name=f'inference-{index}',
+                                      args=(names, self.slots, self.frame_shape, backend, model_path, device, threads, self.tasks, self.done))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        self.free_slots = list(range(self.slots))
+        self.in_flight = {}
+        self.finished = {}
+        self.submitted = 0
+        self.next_sequence = 0
+        self.held_slot = None
+        self.ready = 0
+        self.start_time = None
+        self.completed = 0
+
+    # block until every worker has loaded its model
+    def wait_ready(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.ready < self.workers:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not self._collect(0.5 if remaining is None else min(remaining, 0.5)) and not all(process.is_alive() for process in self.processes):
+                raise RuntimeError('an inference worker exited while loading its model')
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        self.start_time = time.perf_counter()
+        return True
+
+    def has_free_slot(self):
+        return len(self.free_slots) > 0
+
+    # copy a frame into a free slot and queue it, returning its sequence number, or None when every slot is busy
+    def submit(self, frame):
+        if len(self.free_slots) == 0:
+            return None
+        slot = self.free_slots.pop()
+        self.frames[slot][...] = frame
+        sequence = self.submitted
+        self.submitted += 1
+        self.in_flight[sequence] = slot
+        self.tasks.put((slot, sequence))
+        return sequence
+
+    def _collect(self, timeout):
+        try:
+            kind, slot, sequence = self.done.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        if kind == 'ready':
+            self.ready += 1
+        else:
+            self.finished[sequence] = self.in_flight.pop(sequence)
+            self.completed += 1
+        return True
+
+    # (sequence, frame, detections) of the oldest submitted frame once its detections are in, or None on timeout,
+    # the frame is the slot itself and stays valid until the next call, the detections are a copy
+    def next_result(self, timeout=None):
+        if self.held_slot is not None:
+            self.free_slots.append(self.held_slot)
+            self.held_slot = None
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.next_sequence not in self.finished:
+            if self.next_sequence >= self.submitted:
+                return None
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            # a worker that died takes its frame with it, waiting would never end
+            if not self._collect(0.5 if remaining is None else min(remaining, 0.5)) and not all(process.is_alive() for process in self.processes):
+                raise RuntimeError('an inference worker exited')
+
+        sequence = self.next_sequence
+        slot = self.finished.pop(sequence)
+        self.next_sequence += 1
+        self.held_slot = slot
+        return sequence, self.frames[slot], self.results[slot, :self.counts[slot]].copy()
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=2.0)
+            if process.is_alive():
+                process.terminate()
+        del self.frames, self.results, self.counts
+        for memory in (self.frame_memory, self.result_memory, self.count_memory):
+            memory.close()
+            memory.unlink()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        return {
+            'workers': self.workers,
+            'slots': self.slots,
+            'frames': self.completed,
+            'fps': self.completed / elapsed if elapsed > 0 else 0.0
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f'Inference pool: {stats["workers"]} workers, {stats["frames"]} frames at {stats["fps"]:.1f} frames/s')
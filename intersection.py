@@ -0,0 +1,221 @@
+import json
+import time
+import cv2
+from vehicle import Vehicle
+from queuing import ControlQueue, LANE_MAPPINGS, LANE_LINE_MIDPOINTS
+from conflicts import ConflictScheduler
+from color_lut import ColorLUT
+from lane_map import LaneMap
+from pedestrian_tracker import PedestrianTracker
+from fleet import FleetManager
+from overlay import StaticOverlay
+from metrics import metrics
+
+# one intersection's geometry, vehicles and controller, everything main.py used to keep at module level,
+# so several intersections can run side by side, each car in `cars` is controlled here until it leaves
+# through one of the lanes in `exits` ({lane: {"to": intersection, "approach": lane, "direction": turn}})
+class Intersection:
+    def __init__(self, name, boundary_lines, stop_lines, lanes, cars, websocket_uris=(), car_directions=None, default_direction='left',
+                 lane_mappings=None, crossing_durations=None, color_lut=None, pedestrian_ttl=30, pedestrian_crosswalk='bottom',
+                 exits=None, scheduler=None, size=(640, 640)):
+        self.name = name
+        self.boundary_lines = boundary_lines
+        self.stop_lines = stop_lines
+        self.lanes = lanes
+
+        # rasterize the lanes once so each box's lane is a constant-time lookup, and draw the static lines once
+        self.lane_map = LaneMap(lanes, size=size)
+        self.overlay = StaticOverlay(boundary_lines, stop_lines, size=size)
+
+        self.cars = cars
+        self.car_directions = {} if car_directions is None else car_directions
+        self.default_direction = default_direction
+        self.color_lut = ColorLUT.from_vehicles(cars) if color_lut is None else color_lut
+        self.control_queue = ControlQueue(crossing_durations, lane_mappings, scheduler)
+        self.pedestrian_tracker = PedestrianTracker(ttl=pedestrian_ttl)
+        self.pedestrian_crosswalk = pedestrian_crosswalk
+        self.fleet = FleetManager(cars, websocket_uris)
+        self.exits = {} if exits is None else exits
+        self.car_uris = {}
+
+    def identify_vehicle(self, frame, contour):
+        roi = frame[contour[1]: contour[1] + contour[3], contour[0]: contour[0] + contour[2]]
+        return self.color_lut.classify(roi)
+
+    # apply the newest car telemetry, run the controller and hand any changed motor commands to the fleet
+    def control_step(self):
+        self.fleet.apply_telemetry()
+        start = time.perf_counter()
+        self.control_queue.control(self.stop_lines)
+        metrics.since('control', start)
+        metrics.set_gauge('queue_length', len(self.control_queue))
+        self.fleet.push_commands()
+
+    # update the vehicles, pedestrians and control queue from one frame's detections,
+    # the pipeline runs the controller on its own schedule and passes control=False,
+    # draw=False skips annotating frames nobody will see
+    def process_frame(self, frame, detections, control=True, draw=True):
+        metrics.increment('frames_total')
+        cars = self.cars
+        control_queue = self.control_queue
+
+        for car_key in cars:
+            if cars[car_key].time_since_visible > 0:
+                cars[car_key].is_visible = False
+                cars[car_key].time_since_visible = 0
+            else:
+                cars[car_key].time_since_visible += 1
+
+        if control:
+            self.control_step()
+
+        contours = []
+        for detection in detections:
+            coords = [int(coord) for coord in detection[:4]]
+            contours.append([coords[0], coords[1], coords[2] - coords[0], coords[3] - coords[1]])
+
+        # find every detection's lane in one lookup against the lane raster
+        start = time.perf_counter()
+        detection_lanes, _ = self.lane_map.assign(contours)
+        metrics.since('lanes', start)
+        pedestrian_contours = []
+
+        for detection, contour, current_lane in zip(detections, contours, detection_lanes):
+            object_class = 'car' if detection[5] == 0 else 'pedestrian'
+            x, y, w, h = contour
+            if object_class == 'car':
+
+                start = time.perf_counter()
+                name = self.identify_vehicle(frame, [x, y, w, h])
+                metrics.since('identify', start)
+                metrics.increment('detections_total', labels={'class': 'car'})
+
+                # cars controlled by another intersection are only drawn
+                if name not in cars:
+                    name = 'Unidentified'
+
+                if name not in control_queue and name != "Unidentified":
+                    control_queue.addCar(cars[name], self.car_directions.get(name, self.default_direction))
+
+                if name != 'Unidentified':
+                    cars[name].contour = [x, y, w, h]
+                    cars[name].previous_lane = cars[name].lane
+                    cars[name].lane = current_lane
+                    control_queue.update_lane(cars[name])
+
+                    if cars[name].time_since_visible < 51:
+                        cars[name].is_visible = True
+                        cars[name].time_since_visible = 0
+
+                if draw:
+                    cv2.rectangle(frame, (x, y, w, h), (0, 255, 0))
+                    cv2.putText(frame, current_lane, (x - 20, y - 20), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+
+            elif object_class == 'pedestrian':
+                pedestrian_contours.append(contour)
+                metrics.increment('detections_total', labels={'class': 'pedestrian'})
+
+        # match this frame's pedestrians to the tracked ones, only newly seen pedestrians join the queue
+        pedestrians, new_pedestrians = self.pedestrian_tracker.update(pedestrian_contours)
+        for new_pedestrian in new_pedestrians:
+            control_queue.addPedestrian(new_pedestrian, self.pedestrian_crosswalk)
+
+        if draw:
+            for pedestrian in pedestrians:
+                x, y, w, h = pedestrian.contour
+                cv2.rectangle(frame, (x, y, w, h), (191, 0, 191))
+                cv2.putText(frame, pedestrian.id, (x - 20, y - 20), cv2.FONT_HERSHEY_SIMPLEX, 1, (191, 0, 191), 2)
+
+        return frame
+
+    # cars that finished their turn into an exit lane, they stop being controlled here and are returned
+    # as handoff messages for the intersection the exit leads to
+    def departures(self):
+        handoffs = []
+        for car_key in list(self.cars):
+            car = self.cars[car_key]
+            if not car.completed_turn or car.lane not in self.exits:
+                continue
+            exit = self.exits[car.lane]
+            handoffs.append({
+                'car': {'id': car.id, 'color': car.color, 'uri': self.car_uris.get(car.id)},
+                'to': exit['to'],
+                'approach': exit.get('approach'),
+                'direction': exit.get('direction', self.default_direction)
+            })
+            self.release(car_key)
+            print(f'Handing "{car.id}" from "{self.name}" to "{exit["to"]}"')
+        return handoffs
+
+    # stop controlling a car and drop its connection
+    def release(self, car_key):
+        car = self.cars.pop(car_key)
+        self.control_queue.remove_object(car)
+        self.car_directions.pop(car_key, None)
+        uri = self.car_uris.pop(car_key, None)
+        if uri is not None:
+            self.fleet.remove_link(uri)
+
+    # take over a car handed off by a neighbouring intersection, it joins the queue once the camera sees it,
+    # a car already held here only takes the new direction, e.g. a restarted worker that was seeded with the car
+    # and then reads the same handoff from its inbox, so it never gets a second Vehicle or a second link
+    def adopt(self, car_config, direction=None):
+        if car_config['id'] in self.cars:
+            if direction is not None:
+                self.car_directions[car_config['id']] = direction
+            return self.cars[car_config['id']]
+        car = Vehicle({'id': car_config['id'], 'color': car_config['color']})
+        self.cars[car.id] = car
+        self.car_directions[car.id] = self.default_direction if direction is None else direction
+        if car_config.get('uri') is not None:
+            self.car_uris[car.id] = car_config['uri']
+            self.fleet.add_link(car_config['uri'])
+        print(f'Intersection "{self.name}" took over "{car.id}", moving: "{self.car_directions[car.id]}"')
+        return car
+
+# build an intersection from one entry of an intersections config file, lines are lists of [x, y] points,
+# lanes map a lane name to its two bordering points, and every car has an "id", a "color" and optionally a "uri"
+# and a "direction", cars_override replaces the configured cars, e.g. with the ones currently held there
+def intersection_from_config(config, all_cars=None, cars_override=None):
+    def points(line):
+        return [tuple(point) for point in line]
+
+    boundary_lines = [points(line) for line in config['boundary_lines']]
+    stop_lines = {lane: points(line) for lane, line in config['stop_lines'].items()}
+    lanes = {lane: points(line) for lane, line in config['lanes'].items()}
+    car_configs = config.get('cars', []) if cars_override is None else cars_override
+
+    # conflict-matrix scheduling unless turned off, lane_line_midpoints replaces LANE_LINE_MIDPOINTS for other layouts
+    scheduler = None
+    if config.get('conflict_scheduling', True):
+        scheduler = ConflictScheduler(config.get('lane_mappings', LANE_MAPPINGS),
+                                      {lane: tuple(point) for lane, point in config.get('lane_line_midpoints', LANE_LINE_MIDPOINTS).items()},
+                                      compatibility_bonus=config.get('compatibility_bonus', 2.0),
+                                      max_wait=config.get('max_wait', 30.0),
+                                      max_crossing=config.get('max_crossing', 10.0))
+    cars = {car['id']: Vehicle({'id': car['id'], 'color': car['color']}) for car in car_configs}
+
+    # cars can arrive from other intersections, so every car of the deployment must be recognizable here
+    known_cars = {car['id']: Vehicle({'id': car['id'], 'color': car['color']}) for car in (all_cars or car_configs)}
+    intersection = Intersection(config['name'], boundary_lines, stop_lines, lanes, cars,
+                                websocket_uris=[car['uri'] for car in car_configs if car.get('uri') is not None],
+                                car_directions={car['id']: car['direction'] for car in car_configs if 'direction' in car},
+                                default_direction=config.get('default_direction', 'left'),
+                                lane_mappings=config.get('lane_mappings'),
+                                crossing_durations=config.get('crossing_durations'),
+                                color_lut=ColorLUT.load(config['color_lut']) if 'color_lut' in config else ColorLUT.from_vehicles(known_cars),
+                                pedestrian_ttl=config.get('pedestrian_ttl', 30),
+                                pedestrian_crosswalk=config.get('pedestrian_crosswalk', 'bottom'),
+                                exits=config.get('exits'),
+                                scheduler=scheduler)
+    intersection.car_uris = {car['id']: car['uri'] for car in car_configs if car.get('uri') is not None}
+    return intersection
+
+# read an intersections config file, a JSON object with an "intersections" list
+def load_config(path):
+    with open(path) as config_file:
+        return json.load(config_file)
+
+# every car of every intersection in a config
+def all_car_configs(config):
+    return [car for intersection in config['intersections'] for car in intersection.get('cars', [])]
@@ -0,0 +1,144 @@
+from collections import deque
+import numpy
+from geometry import iou_matrix
+from pedestrian_tracker import assign
+
+# constant-velocity Kalman filter over a box's center, with its width and height held constant,
+# state is [cx, cy, w, h, vx, vy] and one step is one frame
+class KalmanBox:
+    def __init__(self, contour, process_noise=1.0, measurement_noise=4.0):
+        x, y, w, h = contour
+        self.state = numpy.array([x + w / 2, y + h / 2, w, h, 0.0, 0.0])
+        self.covariance = numpy.diag([measurement_noise, measurement_noise, measurement_noise, measurement_noise, 100.0, 100.0])
+
+        self.transition = numpy.eye(6)
+        self.transition[0, 4] = 1.0
+        self.transition[1, 5] = 1.0
+        self.measurement = numpy.eye(4, 6)
+        self.process_noise = numpy.diag([process_noise, process_noise, process_noise / 4, process_noise / 4, process_noise / 2, process_noise / 2])
+        self.measurement_noise = numpy.eye(4) * measurement_noise
+
+    def predict(self):
+        self.state = self.transition @ self.state
+        self.covariance = self.transition @ self.covariance @ self.transition.T + self.process_noise
+        return self.contour()
+
+    def update(self, contour):
+        x, y, w, h = contour
+        residual = numpy.array([x + w / 2, y + h / 2, w, h]) - self.measurement @ self.state
+        innovation = self.measurement @ self.covariance @ self.measurement.T + self.measurement_noise
+        gain = self.covariance @ self.measurement.T @ numpy.linalg.inv(innovation)
+        self.state = self.state + gain @ residual
+        self.covariance = (numpy.eye(6) - gain @ self.measurement) @ self.covariance
+
+    # current estimate as an [x, y, w, h] contour
+    def contour(self):
+        cx, cy, w, h = self.state[:4]
+        return [cx - w / 2, cy - h / 2, w, h]
+
+# a detected object between detector runs
+class Track:
+    def __init__(self, contour, object_class, confidence):
+        self.filter = KalmanBox(contour)
+        self.object_class = object_class
+        self.confidence = confidence
+
+    # [x1, y1, x2, y2, confidence, class] detection row, clipped to a (height, width) frame when one is given
+    def row(self, frame_size=None):
+        x, y, w, h = self.filter.contour()
+        x1, y1, x2, y2 = x, y, x + w, y + h
+        if frame_size is not None:
+            height, width = frame_size
+            x1, x2 = min(max(x1, 0), width), min(max(x2, 0), width)
+            y1, y2 = min(max(y1, 0), height), min(max(y2, 0), height)
+        return [x1, y1, x2, y2, self.confidence, self.object_class]
+
+def detection_contour(detection):
+    return [detection[0], detection[1], detection[2] - detection[0], detection[3] - detection[1]]
+
+# wrap a detector so the model only runs every `every` frames, or sooner when a detection's confidence
+# falls below min_confidence, and the boxes in between come from per-object Kalman predictions,
+# tracks start from the first detection of each object, the model always runs while there are none
+class PredictiveDetector:
+    def __init__(self, detector, every=3, min_confidence=0.6, iou_threshold=0.1):
+        self.detector = detector
+        self.every = every
+        self.min_confidence = min_confidence
+        self.iou_threshold = iou_threshold
+        self.tracks = []
+        self.frames_since_detection = every
+        self.detector_runs = 0
+        self.predicted_frames = 0
+
+        # pixel distance between the predicted and the detected box centers, for each matched object
+        self.drift = deque(maxlen=1000)
+
+    def needs_detection(self):
+        if self.frames_since_detection >= self.every or len(self.tracks) == 0:
+            return True
+        return any(track.confidence < self.min_confidence for track in self.tracks)
+
+    def detect(self, frame):
+        for track in self.tracks:
+            track.filter.predict()
+
+        if not self.needs_detection():
+            self.frames_since_detection += 1
+            self.predicted_frames += 1
+            # predicted boxes are clipped to the frame, and a track that coasted out of it is dropped,
+            # so no box ever holds negative coordinates that would wrap around as an ROI slice
+            rows = [track.row(frame.shape[:2]) for track in self.tracks]
+            self.tracks = [track for track, row in zip(self.tracks, rows) if row[2] > row[0] and row[3] > row[1]]
+            return numpy.array([row for row in rows if row[2] > row[0] and row[3] > row[1]], dtype=numpy.float32).reshape(-1, 6)
+
+        detections = self.detector.detect(frame)
+        self.frames_since_detection = 1
+        self.detector_runs += 1
+        self.correct(detections)
+        return detections
+
+    # correct the predictions with a detector result, the detector decides which objects exist
+    def correct(self, detections):
+        predicted = numpy.array([track.row()[:4] for track in self.tracks]).reshape(-1, 4)
+        matched = [None] * len(detections)
+
+        if len(self.tracks) > 0 and len(detections) > 0:
+            iou = iou_matrix(detections[:, :4], predicted)
+            # never match objects of different classes
+            iou[detections[:, 5][:, None] != numpy.array([track.object_class for track in self.tracks])[None, :]] = 0
+            for row, column in zip(*assign(iou)):
+                if iou[row, column] > self.iou_threshold:
+                    matched[row] = self.tracks[column]
+                    detected_center = (detections[row, :2] + detections[row, 2:4]) / 2
+                    predicted_center = (predicted[column, :2] + predicted[column, 2:]) / 2
+                    self.drift.append(float(numpy.linalg.norm(detected_center - predicted_center)))
+
+        tracks = []
+        for detection, track in zip(detections, matched):
+            if track is None:
+                track = Track(detection_contour(detection), detection[5], detection[4])
+            else:
+                track.filter.update(detection_contour(detection))
+                track.confidence = detection[4]
+            tracks.append(track)
+        self.tracks = tracks
+
+    def stats(self):
+        drift = numpy.array(self.drift)
+        frames = self.detector_runs + self.predicted_frames
+        return {
+            'detector_runs': self.detector_runs,
+            'predicted_frames': self.predicted_frames,
+            'detection_rate': self.detector_runs / frames if frames > 0 else 0.0,
+            'drift_px': {
+                'mean': float(drift.mean()) if len(drift) > 0 else 0.0,
+                'p95': float(numpy.percentile(drift, 95)) if len(drift) > 0 else 0.0,
+                'max': float(drift.max()) if len(drift) > 0 else 0.0,
+            }
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        drift = stats['drift_px']
+        print(f'Detector ran on {stats["detector_runs"]} frames, predicted {stats["predicted_frames"]} ({stats["detection_rate"] * 100:.1f}% detected)')
+        print(f'Prediction drift (px): mean {drift["mean"]:.1f}, p95 {drift["p95"]:.1f}, max {drift["max"]:.1f}')
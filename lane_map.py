@@ -0,0 +1,58 @@
+import numpy
+
+UNDEFINED = 'Undefined'
+
+# rasterized lane layout, a label image answers "which lane is this pixel in" and one integral image per lane
+# gives the overlap area between any box and that lane in constant time
+class LaneMap:
+    def __init__(self, lanes, size=(640, 640)):
+        self.lane_keys = list(lanes)
+        self.height, self.width = size
+
+        # -1 marks pixels outside every lane, where lanes overlap the first one listed wins
+        self.labels = numpy.full((self.height, self.width), -1, dtype=numpy.int16)
+        self.integrals = numpy.zeros((len(self.lane_keys), self.height + 1, self.width + 1), dtype=numpy.int32)
+
+        for index, lane_key in enumerate(self.lane_keys):
+            (left, top), (right, bottom) = lanes[lane_key]
+            left, right = numpy.clip([left, right], 0, self.width)
+            top, bottom = numpy.clip([top, bottom], 0, self.height)
+
+            mask = numpy.zeros((self.height, self.width), dtype=numpy.int32)
+            mask[top:bottom, left:right] = 1
+            self.labels[(mask == 1) & (self.labels == -1)] = index
+            self.integrals[index, 1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+    # lane key under a pixel
+    def lane_at(self, point):
+        x, y = int(point[0]), int(point[1])
+        if 0 <= x < self.width and 0 <= y < self.height and self.labels[y, x] >= 0:
+            return self.lane_keys[self.labels[y, x]]
+        return UNDEFINED
+
+    # overlap area between every [x, y, w, h] box and every lane, as a (boxes, lanes) array
+    def overlaps(self, boxes):
+        boxes = numpy.asarray(boxes, dtype=numpy.int64).reshape(-1, 4)
+        left = boxes[:, 0].clip(0, self.width)
+        top = boxes[:, 1].clip(0, self.height)
+        right = numpy.maximum((boxes[:, 0] + boxes[:, 2]).clip(0, self.width), left)
+        bottom = numpy.maximum((boxes[:, 1] + boxes[:, 3]).clip(0, self.height), top)
+
+        integrals = self.integrals
+        areas = integrals[:, bottom, right] - integrals[:, top, right] - integrals[:, bottom, left] + integrals[:, top, left]
+        return areas.T
+
+    # best lane and overlap area for every box in one vectorized call, boxes touching no lane get 'Undefined'
+    def assign(self, boxes):
+        areas = self.overlaps(boxes)
+        if areas.shape[1] == 0:
+            return [UNDEFINED] * len(areas), numpy.zeros(len(areas), dtype=numpy.int32)
+        best = areas.argmax(axis=1)
+        best_areas = areas[numpy.arange(len(areas)), best]
+        lane_keys = [self.lane_keys[index] if area > 0 else UNDEFINED for index, area in zip(best, best_areas)]
+        return lane_keys, best_areas
+
+    # best lane and overlap area for a single [x, y, w, h] box
+    def best_lane(self, box):
+        lane_keys, areas = self.assign([box])
+        return lane_keys[0], int(areas[0])
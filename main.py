@@ -1,19 +1,33 @@
 import cv2
-import threading
-import websocket
-import json
-import numpy
 import os
 import signal
+import sys
 import time
-from ultralytics import YOLO
 from vehicle import Vehicle
-from pedestrian import Pedestrian
-from queuing import ControlQueue
 from video_capture import VideoCapture
+from multi_camera import CameraRig, load_rig
+from pipeline import Pipeline
+from inference_pool import InferencePool
+from detector import create_detector, build_detector as build_wrapped_detector, DEFAULT_BACKEND
+from color_lut import ColorLUT
+from telemetry_store import TelemetryRing
+from intersection import Intersection
+from conflicts import ConflictScheduler
+from metrics import metrics
 
 window_name = "Ceiling Camera Feed"
 
+# camera device, capture resolution and OpenCV backend (None picks DirectShow on Windows, automatic elsewhere)
+camera_source = 0
+camera_width = 1920
+camera_height = 1080
+camera_backend = None
+
+# a JSON rig definition replaces camera_source with several cameras, each mapped into this frame by a homography,
+# see multi_camera.py, the model runs once per tick on the batch of frames and frame skipping and motion gating are off
+camera_rig_path = None
+camera_rig = None
+
 # define intersections lane lines and border lines
 boundary_lines = [
     #octagon
@@ -76,6 +90,19 @@ cars = {
     'orange-car': Vehicle({'id': 'orange-car', 'color': [208,162,64]})
 }
 
+# keep the last telemetry_capacity telemetry messages of every car, memory-mapped into telemetry_dir when it is set
+telemetry_capacity = 4096
+telemetry_dir = None
+if telemetry_dir is not None:
+    os.makedirs(telemetry_dir, exist_ok=True)
+for car_key in cars:
+    telemetry_path = os.path.join(telemetry_dir, car_key + '.npy') if telemetry_dir is not None else None
+    cars[car_key].telemetry = TelemetryRing(telemetry_capacity, telemetry_path)
+
+# map pixel colors to cars, a table calibrated with color_lut.py replaces the +/- 5 window around each car's color
+color_lut_path = './data/color_lut.npz'
+color_lut = ColorLUT.load(color_lut_path) if os.path.exists(color_lut_path) else ColorLUT.from_vehicles(cars)
+
 # define car websockets
 websocket_uris = [
     "ws://172.20.10.10:8765",
@@ -83,187 +110,236 @@ websocket_uris = [
 ]
 
 intend_turns = False
-control_queue = ControlQueue()
-
-# load pedestrian and vehicle detection Yolo v8 CNN model
-model = YOLO('./data/model.pt')
 
-ws_array = []
+# run capture, inference, tracking and control as separate stages, with control ticking at control_rate Hz
+use_pipeline = True
+control_rate = 20
+
+# 'window' shows every frame, 'preview' draws and shows every preview_every-th frame, 'headless' never draws or shows
+display_mode = 'window'
+preview_every = 5
+
+# load pedestrian and vehicle detection Yolo v8 CNN model,
+# detector_backend is one of 'ultralytics' (CUDA device 0), 'onnx' or 'openvino' (CPU)
+detector_backend = os.environ.get('DETECTOR_BACKEND', DEFAULT_BACKEND)
+model_path = './data/model.pt'
+detector = None
+
+# run the model every detect_every frames (1 runs it on every frame), predicting boxes in between,
+# a detection below redetect_confidence forces the model to run on the next frame
+detect_every = 1
+redetect_confidence = 0.6
+
+# skip the model while the downscaled scene is unchanged since it last ran, reusing its detections
+motion_gating = True
+
+# run the model in inference_workers processes fed through shared memory instead of on this process (0 to disable),
+# frames are handled in capture order as their detections come back, this replaces the pipeline,
+# and frame skipping and motion gating are off since they need every frame in one process
+inference_workers = 0
+
+# pedestrians are forgotten after going unseen for pedestrian_ttl frames
+pedestrian_ttl = 30
+
+# let every car at a stop line whose movement does not conflict with the traffic inside enter together,
+# each other waiting car a car could go alongside counts as compatibility_bonus seconds of waiting,
+# and no car waits more than about max_wait seconds, a released car the camera lost mid-turn stops blocking others
+# max_crossing seconds after it was last seen, None lets every car at a stop line go
+scheduler = ConflictScheduler(compatibility_bonus=2.0, max_wait=30.0, max_crossing=10.0)
+
+# the layout above as one intersection with its own lane raster, overlay, control queue, pedestrian tracker
+# and fleet (one event loop connecting to every car, see fleet.py), supervisor.py runs several from a config file
+intersection = Intersection('main', boundary_lines, stop_lines, lanes, cars, websocket_uris,
+                            car_directions={'green-car': 'right'}, default_direction='left',
+                            color_lut=color_lut, pedestrian_ttl=pedestrian_ttl, scheduler=scheduler)
+lane_map = intersection.lane_map
+overlay = intersection.overlay
+control_queue = intersection.control_queue
+fleet = intersection.fleet
+pedestrian_tracker = intersection.pedestrian_tracker
+
+# per-stage latency histograms and counters are served in Prometheus text format on metrics_port (None to disable),
+# and appended as JSON to metrics_snapshot_path every metrics_snapshot_interval seconds when it is set
+metrics_port = 9100
+metrics_snapshot_path = None
+metrics_snapshot_interval = 10.0
 
 # control_queue.addCar(cars['green-car'], 'right')
 # control_queue.addCar(cars['orange-car'], 'forward')
 
+# set by the first Ctrl+C so the main loop ends and everything shuts down and reports its stats,
+# a second Ctrl+C ends the program at once
+stop_requested = False
+
 def exit_handler(signal, frame):
-    print('\n\nCtrl+C detected. Ending Program.')
-    os._exit(1)
+    global stop_requested
+    if stop_requested:
+        print('\n\nCtrl+C detected again. Ending Program.')
+        os._exit(1)
+    print('\n\nCtrl+C detected. Stopping, press Ctrl+C again to end the program at once.')
+    stop_requested = True
 
 def identifyVehicle(frame, contour):
-    roi = frame[contour[1]: contour[1] + contour[3], contour[0]: contour[0] + contour[2]]
-    for car_key in cars:
-        car = cars[car_key]
-        target_color = car.color
-        threshold = 5
-        lower_range = numpy.array([target_color[2]-threshold, target_color[1]-threshold, target_color[0]-threshold])
-        upper_range = numpy.array([target_color[2]+threshold, target_color[1]+threshold, target_color[0]+threshold])
-
-        mask = cv2.inRange(roi, lower_range, upper_range)
-        
-        if numpy.count_nonzero(mask) > 0:
-            return car_key
-    return 'Unidentified'
-
-def intersectionBetweenRectangles(r1_left, r1_right, r2_left, r2_right):
-    x = 0
-    y = 1
-
-    x_dist = (min(r1_right[x], r2_right[x]) - max(r1_left[x], r2_left[x]))
-    y_dist = (min(r1_right[y], r2_right[y]) - max(r1_left[y], r2_left[y]))
-
-    area_of_intersection = 0
-
-    if x_dist > 0 and y_dist > 0:
-        area_of_intersection = x_dist * y_dist
-    
-    return area_of_intersection
-
-def itemIdentification(new_object, all_objects):
-    for test_object in all_objects:
-        intersection = intersectionBetweenRectangles([test_object.contour[0], test_object.contour[1]], [test_object.contour[2] + test_object.contour[0], test_object.contour[3] + test_object.contour[1]], [new_object.contour[0], new_object.contour[1]], [new_object.contour[2] + new_object.contour[0], new_object.contour[3] + new_object.contour[1]])
-        if intersection > 0:
-            return test_object
-    return None
-
-def on_message(ws, message):
-    if 'pong' not in message and message != 'A':
-        data = json.loads(message)
-        car = cars[data['Name']]
-        time.sleep(.025)
-        ws.send(json.dumps({"motors": car.motor_speeds}))
-        car.greyscale = data['A']
-        car.currentSpeed = data['B']
-        car.mileage = data['C']
-        car.sonar_angle = data['D'][0]
-        car.sonar_distance = data['D'][1]
-        
-
-def on_error(ws, error):
-    print(f"Error occurred: {error}")
-
-def on_close(ws, status_code, close_msg):
-    print("Connection closed")
-
-def on_open(ws):
-    print("Connection opened")
+    return intersection.identify_vehicle(frame, contour)
+
+# apply the newest car telemetry, run the controller and hand any changed motor commands to the fleet
+def control_step():
+    intersection.control_step()
+
+# create the model for a backend with this file's frame-skipping and motion gating settings
+def build_detector(backend, device=0, threads=None):
+    return build_wrapped_detector(backend, model_path, device=device, threads=threads, detect_every=detect_every,
+                                  redetect_confidence=redetect_confidence, motion_gating=motion_gating)
+
+# the detector and every detector it wraps, outermost first
+def detector_chain(stage):
+    chain = []
+    while stage is not None:
+        chain.append(stage)
+        stage = getattr(stage, 'detector', None)
+    return chain
+
+# run the detector on a frame, returning one [x1, y1, x2, y2, confidence, class] row per detection
+# or on the list of a camera rig's frames, returning the merged rows in the intersection frame
+def detect(frame):
+    start = time.perf_counter()
+    detections = camera_rig.detect(frame) if camera_rig is not None else detector.detect(frame)
+    metrics.since('detect', start)
+    return detections
+
+# update the vehicles, pedestrians and control queue from one frame's detections,
+# the pipeline runs the controller on its own schedule and passes control=False,
+# draw=False skips annotating frames nobody will see
+def process_frame(frame, detections, control=True, draw=True):
+    return intersection.process_frame(frame, detections, control=control, draw=draw)
+
+# show a frame with the intersection lines over it, returning False once the user asks to quit
+def show_frame(frame):
+    if frame is not None:
+        start = time.perf_counter()
+        overlay.apply(frame)
+        cv2.imshow(window_name, frame)
+        metrics.since('draw', start)
 
-def main():
-    cv2.namedWindow(window_name)
-    camera = VideoCapture(0) 
-    pedestrian_counter = 0
-    current_pedestrians = []
-    index = 0
-
-    for uri in websocket_uris:
-        ws = websocket.WebSocketApp(uri,
-                                    on_message = on_message,
-                                    on_error = on_error,
-                                    on_close = on_close,
-                                    on_open = on_open)
-        wst = threading.Thread(target=ws.run_forever)
-        wst.daemon = True
-        wst.start()
-        index += 1
-
-    while True:
-        frame = camera.read()
-        frame = cv2.resize(frame, (640, 640))
-        result = model.predict(frame, max_det=6, verbose=False, device=0, conf=0.5, vid_stride=True)[0]
-
-        for car_key in cars:
-            if cars[car_key].time_since_visible > 0:
-                cars[car_key].is_visible = False
-                cars[car_key].time_since_visible = 0
-            else:
-                cars[car_key].time_since_visible += 1
-
-        control_queue.control(stop_lines)
-
-        for box in result.boxes:
-            object_class = 'car' if box.cls.detach().cpu().numpy()[0] == 0 else 'pedestrian'
-            coords = [int(coord) for coord in box.xyxy.detach().cpu().numpy()[0]]
-            x = coords[0]
-            y = coords[1]
-            w = coords[2] - coords[0]
-            h = coords[3] - coords[1]   
-            if object_class == 'car':
-
-                name = identifyVehicle(frame, [x, y, w, h])
-                vehicle_in_queue = False
-                for object in control_queue.queue:
-                    if isinstance(object, Vehicle) and object.id == name:
-                        vehicle_in_queue = True
-                if not vehicle_in_queue and name != "Unidentified":
-                    if name == 'green-car':
-                        control_queue.addCar(cars[name], 'right')
-                    else:
-                        control_queue.addCar(cars[name], 'left')
-                area = 0
-                current_lane = 'Undefined'
-
-                for lane_key in lanes:
-                    lane = lanes[lane_key]
-                    lane_x = lane[0][0]
-                    lane_y = lane[0][1]
-                    lane_w = lane[1][0] - lane_x
-                    lane_h = lane[1][1] - lane_y
-
-                    if x + w >= lane_x and x <= lane_x + lane_w and y + h >= lane_y and y <= lane_y + lane_h:
-                        new_intersection = intersectionBetweenRectangles((x, y),(x + w, y + h), lane[0], lane[1])
-                        if new_intersection > area:
-                            area = new_intersection
-                            current_lane = lane_key
-
-                    if name != 'Unidentified':
-                        cars[name].contour = [x, y, w, h]
-                        cars[name].previous_lane = cars[name].lane
-                        cars[name].lane = current_lane
-
-                        if cars[name].time_since_visible < 51:
-                            cars[name].is_visible = True
-                            cars[name].time_since_visible = 0
-
-                cv2.rectangle(frame, (x, y, w, h), (0, 255, 0))
-                cv2.putText(frame, current_lane, (x - 20, y - 20), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-
-            elif object_class == 'pedestrian':
-                
-                new_pedestrian = Pedestrian({'id': 'pedestrian_' + str(pedestrian_counter)})
-                new_pedestrian.contour = [x,y,w,h]
-
-                identify_pedestrian = itemIdentification(new_pedestrian, current_pedestrians)
-
-                if identify_pedestrian != None:
-                    identify_pedestrian.contour = new_pedestrian.contour
-                    new_pedestrian = identify_pedestrian
-                else:
-                    current_pedestrians.append(new_pedestrian)
-                    pedestrian_counter += 1
-                    control_queue.addPedestrian(new_pedestrian, 'bottom')
-
-                cv2.rectangle(frame, (coords[0], coords[1], coords[2] - coords[0], coords[3] - coords[1]), (191, 0, 191))
-                cv2.putText(frame, new_pedestrian.id, (x - 20, y - 20), cv2.FONT_HERSHEY_SIMPLEX, 1, (191, 0, 191), 2)
-
-        [cv2.line(frame, line[0], line[1], (0, 0, 255), 3) for line in boundary_lines]
-        [cv2.line(frame, stop_lines[line_key][0], stop_lines[line_key][1], (255, 0, 0), 3) for line_key in stop_lines]
+    keyCode = cv2.waitKey(1) & 0xFF
+    return not (keyCode == 27 or keyCode == ord('q'))
 
-        cv2.imshow(window_name, frame)
+# every how many frames one is drawn and shown, 0 for never
+def display_interval():
+    if display_mode == 'headless':
+        return 0
+    elif display_mode == 'preview':
+        return preview_every
+    return 1
 
-        keyCode = cv2.waitKey(1) & 0xFF
-        if keyCode == 27 or keyCode == ord('q'):
-            break
+def main():
+    global detector, camera_rig
+
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+    if metrics_snapshot_path is not None:
+        metrics.write_snapshots(metrics_snapshot_path, metrics_snapshot_interval)
+
+    interval = display_interval()
+    if interval > 0:
+        cv2.namedWindow(window_name)
+
+    if camera_rig_path is not None:
+        detector = create_detector(detector_backend, model_path, device=0, dynamic_batch=True)
+        camera_rig = CameraRig(load_rig(camera_rig_path), detector)
+        camera = camera_rig
+        # the model sees each camera's own frame, tracking and the display see their composite
+        composite = camera_rig.compose
+    else:
+        detector = build_detector(detector_backend, device=0) if inference_workers == 0 else None
+        camera = VideoCapture(camera_source, width=camera_width, height=camera_height, backend=camera_backend, output_size=(640, 640))
+        composite = lambda frame: frame
+
+    fleet.start()
+
+    if inference_workers > 0 and camera_rig is None:
+        pool = InferencePool(detector_backend, model_path, workers=inference_workers)
+        pool.wait_ready()
+
+        frame_index = 0
+        capturing = True
+        # capture time of every frame in the pool, by submission sequence
+        capture_times = {}
+        while not stop_requested:
+            # keep every slot busy with the newest frames, then handle the oldest one whose detections are in
+            while capturing and pool.has_free_slot():
+                frame, capture_time = camera.read_timestamped()
+                if frame is None:
+                    capturing = False
+                    break
+                capture_times[pool.submit(frame)] = capture_time
+
+            result = pool.next_result()
+            if result is None:
+                break
+            sequence, frame, detections = result
+            show = interval > 0 and frame_index % interval == 0
+            process_frame(frame, detections, draw=show)
+            metrics.observe('frame_to_command', time.monotonic() - capture_times.pop(sequence))
+            frame_index += 1
+
+            if show and not show_frame(frame):
+                break
+
+        pool.close()
+        pool.print_stats()
+    elif use_pipeline:
+        # frames outlive the next read in the pipeline, so each one holds its capture buffer until the pipeline releases it
+        pipeline = Pipeline(lambda: camera.read_timestamped(hold=True),
+                            detect,
+                            lambda frame, detections, draw: process_frame(composite(frame), detections, control=False, draw=draw),
+                            control_step,
+                            control_rate=control_rate,
+                            display_every=interval,
+                            release_frame=camera.release_frame)
+        pipeline.start()
+
+        if interval > 0:
+            while not stop_requested and show_frame(pipeline.next_display_frame(timeout=0.1)):
+                pass
+        else:
+            # headless runs until Ctrl+C or until the camera stops
+            while not stop_requested and pipeline.threads[0].is_alive():
+                time.sleep(0.1)
+
+        pipeline.stop()
+        pipeline.print_stats()
+    else:
+        frame_index = 0
+        while not stop_requested:
+            frame, capture_time = camera.read_timestamped()
+            if frame is None:
+                break
+            detections = detect(frame)
+            show = interval > 0 and frame_index % interval == 0
+            frame = process_frame(composite(frame), detections, draw=show)
+            metrics.observe('frame_to_command', time.monotonic() - capture_time)
+            frame_index += 1
+
+            if show and not show_frame(frame):
+                break
+
+    fleet.stop()
+    fleet.print_stats()
+    for car_key in cars:
+        cars[car_key].telemetry.flush()
+    for stage in detector_chain(detector):
+        if hasattr(stage, 'print_stats'):
+            stage.print_stats()
 
+    camera.print_stats()
     camera.release()
-    cv2.destroyAllWindows()
-    os._exit(1)
+    # headless OpenCV builds have no window support at all
+    if interval > 0:
+        cv2.destroyAllWindows()
+    # os._exit skips flushing, the stats above must still reach a redirected stdout
+    sys.stdout.flush()
+    os._exit(0)
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, exit_handler)
@@ -0,0 +1,173 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'intersection'
+
+# stage latency bucket bounds in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+def label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+# cumulative latency histogram with fixed buckets
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # approximate quantile from the bucket bounds
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+# per-stage latency histograms, counters and gauges, served as Prometheus text and optionally written to a file
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.start_time = time.time()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    # record the time since a time.perf_counter() start under a stage
+    def since(self, stage, start):
+        self.observe(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.since(stage, start)
+
+    def increment(self, name, amount=1, labels=None):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            if len(self.histograms) > 0:
+                lines.append(f'# TYPE {PREFIX}_stage_seconds histogram')
+            for stage in sorted(self.histograms):
+                histogram = self.histograms[stage]
+                stage_label = (('stage', stage),)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{PREFIX}_stage_seconds_bucket{format_labels(stage_label, (("le", bound),))} {cumulative}')
+                lines.append(f'{PREFIX}_stage_seconds_bucket{format_labels(stage_label, (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{PREFIX}_stage_seconds_sum{format_labels(stage_label)} {histogram.sum}')
+                lines.append(f'{PREFIX}_stage_seconds_count{format_labels(stage_label)} {histogram.count}')
+
+            typed = set()
+            for (name, key), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {PREFIX}_{name} counter')
+                    typed.add(name)
+                lines.append(f'{PREFIX}_{name}{format_labels(key)} {value}')
+            for (name, key), value in sorted(self.gauges.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {PREFIX}_{name} gauge')
+                    typed.add(name)
+                lines.append(f'{PREFIX}_{name}{format_labels(key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time.time(),
+                'uptime_s': time.time() - self.start_time,
+                'stages': {stage: {
+                    'count': histogram.count,
+                    'mean_ms': histogram.sum / histogram.count * 1000 if histogram.count > 0 else 0.0,
+                    'p50_ms': histogram.quantile(0.5) * 1000,
+                    'p95_ms': histogram.quantile(0.95) * 1000
+                } for stage, histogram in self.histograms.items()},
+                'counters': {name + format_labels(key): value for (name, key), value in self.counters.items()},
+                'gauges': {name + format_labels(key): value for (name, key), value in self.gauges.items()}
+            }
+
+    # serve /metrics on a local port from a background thread, returns None without serving when the port
+    # cannot be bound, metrics must never stop the controller from starting
+    def serve(self, port=9100, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as error:
+            print(f'Metrics not served, could not bind {host}:{port}: {error}')
+            return None
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print(f'Metrics served on http://{host}:{port}/metrics')
+        return server
+
+    # append a JSON snapshot line to a file every interval seconds from a background thread
+    def write_snapshots(self, path, interval=10.0):
+        def writer():
+            while True:
+                time.sleep(interval)
+                with open(path, 'a') as snapshot_file:
+                    snapshot_file.write(json.dumps(self.snapshot()) + '\n')
+
+        thread = threading.Thread(target=writer)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+# process-wide registry
+metrics = Metrics()
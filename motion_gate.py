@@ -0,0 +1,55 @@
+import cv2
+import numpy
+
+# wrap a detector so the model is skipped while the scene matches the frame it last ran on,
+# frames are compared as small blurred greyscale images and the last detections are reused when nothing moved
+class GatedDetector:
+    def __init__(self, detector, size=(80, 80), pixel_threshold=20, changed_fraction=0.002, max_skip=150):
+        self.detector = detector
+        self.size = size
+        self.pixel_threshold = pixel_threshold
+        self.changed_fraction = changed_fraction
+        self.max_skip = max_skip
+
+        self.reference = None
+        self.last_detections = None
+        self.skipped_in_a_row = 0
+        self.frames = 0
+        self.skipped = 0
+
+    def thumbnail(self, frame):
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (3, 3), 0)
+
+    # fraction of thumbnail pixels that changed noticeably since the model last ran
+    def motion(self, thumbnail):
+        difference = cv2.absdiff(thumbnail, self.reference)
+        return numpy.count_nonzero(difference > self.pixel_threshold) / difference.size
+
+    def detect(self, frame):
+        self.frames += 1
+        thumbnail = self.thumbnail(frame)
+
+        # compare against the frame the model last saw, so slow movement still adds up to a change,
+        # and run the model at least every max_skip frames regardless
+        if self.reference is not None and self.skipped_in_a_row < self.max_skip and self.motion(thumbnail) < self.changed_fraction:
+            self.skipped += 1
+            self.skipped_in_a_row += 1
+            return self.last_detections
+
+        self.last_detections = self.detector.detect(frame)
+        self.reference = thumbnail
+        self.skipped_in_a_row = 0
+        return self.last_detections
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'skip_rate': self.skipped / self.frames if self.frames > 0 else 0.0
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f'Motion gate skipped {stats["skipped"]} of {stats["frames"]} frames ({stats["skip_rate"] * 100:.1f}%)')
@@ -0,0 +1,159 @@
+import json
+import cv2
+import numpy
+from geometry import iou_matrix
+from video_capture import VideoCapture
+
+# one camera of a rig and the homography taking its (output_size) pixels into the shared intersection frame,
+# which is the 640x640 frame boundary_lines, stop_lines and LANE_LINE_MIDPOINTS are drawn in
+class RigCamera:
+    def __init__(self, name, source, homography, width=1920, height=1080, backend=None, output_size=(640, 640)):
+        self.name = name
+        self.source = source
+        self.homography = numpy.asarray(homography, dtype=numpy.float64).reshape(3, 3)
+        self.output_size = output_size
+        self.capture = VideoCapture(source, width=width, height=height, backend=backend, output_size=output_size)
+
+# homography from a list of [[camera x, camera y], [intersection x, intersection y]] point pairs, at least 4
+def homography_from_points(points):
+    points = numpy.asarray(points, dtype=numpy.float64)
+    if len(points) < 4:
+        raise ValueError('a homography needs at least 4 point pairs')
+    homography, _ = cv2.findHomography(points[:, 0], points[:, 1], cv2.RANSAC if len(points) > 4 else 0)
+    if homography is None:
+        raise ValueError('point pairs do not define a homography')
+    return homography
+
+# read a rig definition, a JSON object with a "cameras" list whose entries name a "source" and either a 3x3
+# "homography" or calibration "points", plus optional "width", "height" and "backend"
+def load_rig(path, output_size=(640, 640)):
+    with open(path) as rig_file:
+        config = json.load(rig_file)
+
+    cameras = []
+    for index, camera in enumerate(config['cameras']):
+        homography = camera['homography'] if 'homography' in camera else homography_from_points(camera['points'])
+        cameras.append(RigCamera(camera.get('name', f'camera-{index}'),
+                                 camera['source'],
+                                 homography,
+                                 width=camera.get('width', 1920),
+                                 height=camera.get('height', 1080),
+                                 backend=camera.get('backend'),
+                                 output_size=output_size))
+    return cameras
+
+# map [x1, y1, x2, y2, ...] rows through a homography, each box becomes the bounding box of its projected corners
+def project_detections(detections, homography):
+    detections = numpy.asarray(detections, dtype=numpy.float32).reshape(-1, 6)
+    if len(detections) == 0:
+        return detections
+    corners = detections[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 1, 2)
+    projected = cv2.perspectiveTransform(corners.astype(numpy.float64), homography).reshape(-1, 4, 2)
+    mapped = detections.copy()
+    mapped[:, :2] = projected.min(axis=1)
+    mapped[:, 2:4] = projected.max(axis=1)
+    return mapped
+
+# merge detections of the same object seen by several cameras, greedily from the most confident one,
+# a detection joins a group of its class it overlaps by iou_threshold unless its camera is already in the group,
+# each group becomes one confidence-weighted box with the group's best confidence
+def merge_detections(per_camera, iou_threshold=0.3):
+    rows = [detections for detections in per_camera if len(detections) > 0]
+    if len(rows) == 0:
+        return numpy.zeros((0, 6), dtype=numpy.float32)
+    if len(rows) == 1:
+        return rows[0]
+
+    detections = numpy.concatenate(rows)
+    cameras = numpy.concatenate([numpy.full(len(rows[index]), index) for index in range(len(rows))])
+    order = numpy.argsort(-detections[:, 4], kind='stable')
+    iou = iou_matrix(detections[:, :4], detections[:, :4])
+
+    groups = []
+    for index in order:
+        for group in groups:
+            leader = group[0]
+            if detections[leader, 5] == detections[index, 5] and iou[leader, index] >= iou_threshold and cameras[index] not in cameras[group]:
+                group.append(index)
+                break
+        else:
+            groups.append([index])
+
+    merged = numpy.empty((len(groups), 6), dtype=numpy.float32)
+    for row, group in enumerate(groups):
+        members = detections[group]
+        weights = members[:, 4] / members[:, 4].sum()
+        merged[row, :4] = (members[:, :4] * weights[:, None]).sum(axis=0)
+        merged[row, 4] = members[:, 4].max()
+        merged[row, 5] = members[0, 5]
+    return merged
+
+# run a detector over several frames in one call when it supports batches
+def detect_batch(detector, frames):
+    if hasattr(detector, 'detect_batch'):
+        return detector.detect_batch(frames)
+    return [detector.detect(frame) for frame in frames]
+
+# several cameras covering one intersection, every tick reads each camera's newest frame, runs the model once
+# on the batch and merges the detections in the shared intersection frame, a warped composite of the cameras
+# stands in for the single camera frame so vehicles can still be identified by color and drawn
+class CameraRig:
+    def __init__(self, cameras, detector, canvas_size=(640, 640), iou_threshold=0.3):
+        self.cameras = cameras
+        self.detector = detector
+        self.canvas_size = canvas_size
+        self.iou_threshold = iou_threshold
+
+        # where each camera lands in the composite, and a reused buffer to warp into
+        self.warped = numpy.empty((canvas_size[1], canvas_size[0], 3), dtype=numpy.uint8)
+        self.masks = []
+        for camera in cameras:
+            coverage = numpy.full((camera.output_size[1], camera.output_size[0]), 255, dtype=numpy.uint8)
+            self.masks.append(cv2.warpPerspective(coverage, camera.homography, canvas_size, flags=cv2.INTER_NEAREST))
+
+    # the newest frame of every camera, None once any camera stops
+    def read(self, copy=False):
+        return self.read_timestamped(copy=copy)[0]
+
+    # (frames, capture timestamp of the oldest of them on the time.monotonic clock), with hold=True the frames
+    # stay valid until they are handed back to release_frame
+    def read_timestamped(self, copy=False, hold=False):
+        reads = [camera.capture.read_latest(copy=copy, hold=hold) for camera in self.cameras]
+        if any(frame is None for frame, _, _ in reads):
+            self.release_frame([frame for frame, _, _ in reads])
+            return None, None
+        return [frame for frame, _, _ in reads], min(timestamp for _, _, timestamp in reads)
+
+    # hand back frames read with hold=True, anything other than a list of camera frames is ignored
+    def release_frame(self, frames):
+        if not isinstance(frames, list):
+            return
+        for camera, frame in zip(self.cameras, frames):
+            if frame is not None:
+                camera.capture.release_frame(frame)
+
+    def detect(self, frames):
+        per_camera = detect_batch(self.detector, frames)
+        projected = [project_detections(detections, camera.homography) for detections, camera in zip(per_camera, self.cameras)]
+        merged = merge_detections(projected, self.iou_threshold)
+        # a camera may see past the edge of the intersection frame
+        merged[:, [0, 2]] = merged[:, [0, 2]].clip(0, self.canvas_size[0])
+        merged[:, [1, 3]] = merged[:, [1, 3]].clip(0, self.canvas_size[1])
+        return merged
+
+    # warp every camera into the intersection frame, later cameras win where they overlap
+    def compose(self, frames):
+        canvas = numpy.zeros((self.canvas_size[1], self.canvas_size[0], 3), dtype=numpy.uint8)
+        for frame, camera, mask in zip(frames, self.cameras, self.masks):
+            cv2.warpPerspective(frame, camera.homography, self.canvas_size, dst=self.warped)
+            cv2.copyTo(self.warped, mask, canvas)
+        return canvas
+
+    def release(self):
+        for camera in self.cameras:
+            camera.capture.release()
+
+    def print_stats(self):
+        for camera in self.cameras:
+            print(f'{camera.name}: ', end='')
+            camera.capture.print_stats()
@@ -0,0 +1,15 @@
+import cv2
+import numpy
+
+# the intersection's boundary and stop lines rendered once into a layer that is composited onto each frame in a single copy
+class StaticOverlay:
+    def __init__(self, boundary_lines, stop_lines, size=(640, 640)):
+        height, width = size
+        self.layer = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+        [cv2.line(self.layer, line[0], line[1], (0, 0, 255), 3) for line in boundary_lines]
+        [cv2.line(self.layer, stop_lines[line_key][0], stop_lines[line_key][1], (255, 0, 0), 3) for line_key in stop_lines]
+        self.mask = numpy.any(self.layer > 0, axis=2).astype(numpy.uint8)
+
+    def apply(self, frame):
+        cv2.copyTo(self.layer, self.mask, frame)
+        return frame
@@ -0,0 +1,99 @@
+import numpy
+from pedestrian import Pedestrian
+from geometry import contours_to_boxes, iou_matrix
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+# pair rows and columns of an IoU matrix, optimally with scipy and greedily by best IoU without it
+def assign(iou):
+    if linear_sum_assignment is not None:
+        return linear_sum_assignment(-iou)
+    rows, columns = [], []
+    order = numpy.dstack(numpy.unravel_index(numpy.argsort(-iou, axis=None), iou.shape))[0]
+    used_rows, used_columns = set(), set()
+    for row, column in order:
+        if row not in used_rows and column not in used_columns:
+            rows.append(row)
+            columns.append(column)
+            used_rows.add(row)
+            used_columns.add(column)
+    return numpy.array(rows, dtype=numpy.int64), numpy.array(columns, dtype=numpy.int64)
+
+# track pedestrians between frames, matching detections to live tracks by IoU and
+# dropping tracks that have not been seen for ttl frames, so memory follows the live pedestrian count
+class PedestrianTracker:
+    def __init__(self, ttl=30, iou_threshold=0.05, capacity=16):
+        self.ttl = ttl
+        self.iou_threshold = iou_threshold
+        self.frame_index = 0
+        self.pedestrian_counter = 0
+
+        # track slots, a slot is free when its pedestrian is None
+        self.boxes = numpy.zeros((capacity, 4), dtype=numpy.float32)
+        self.last_seen = numpy.zeros(capacity, dtype=numpy.int64)
+        self.active = numpy.zeros(capacity, dtype=bool)
+        self.pedestrians = [None] * capacity
+
+    def __len__(self):
+        return int(self.active.sum())
+
+    # live pedestrians, in slot order
+    def tracks(self):
+        return [self.pedestrians[slot] for slot in numpy.flatnonzero(self.active)]
+
+    def _free_slot(self):
+        free = numpy.flatnonzero(~self.active)
+        if len(free) > 0:
+            return free[0]
+
+        # every slot is live, double the capacity
+        capacity = len(self.pedestrians)
+        self.boxes = numpy.concatenate((self.boxes, numpy.zeros_like(self.boxes)))
+        self.last_seen = numpy.concatenate((self.last_seen, numpy.zeros_like(self.last_seen)))
+        self.active = numpy.concatenate((self.active, numpy.zeros_like(self.active)))
+        self.pedestrians.extend([None] * capacity)
+        return capacity
+
+    # match this frame's [x, y, w, h] contours to tracks, returning the pedestrian for each contour
+    # and the list of pedestrians that were first seen in this frame
+    def update(self, contours):
+        self.frame_index += 1
+        detections = contours_to_boxes(contours)
+        matched = [None] * len(detections)
+        new_pedestrians = []
+
+        live = numpy.flatnonzero(self.active)
+        if len(live) > 0 and len(detections) > 0:
+            iou = iou_matrix(detections, self.boxes[live])
+            for row, column in zip(*assign(iou)):
+                if iou[row, column] > self.iou_threshold:
+                    slot = live[column]
+                    self.boxes[slot] = detections[row]
+                    self.last_seen[slot] = self.frame_index
+                    self.pedestrians[slot].contour = list(contours[row])
+                    matched[row] = self.pedestrians[slot]
+
+        for row in range(len(detections)):
+            if matched[row] is None:
+                slot = self._free_slot()
+                pedestrian = Pedestrian({'id': 'pedestrian_' + str(self.pedestrian_counter)})
+                pedestrian.contour = list(contours[row])
+                self.pedestrian_counter += 1
+
+                self.boxes[slot] = detections[row]
+                self.last_seen[slot] = self.frame_index
+                self.active[slot] = True
+                self.pedestrians[slot] = pedestrian
+                matched[row] = pedestrian
+                new_pedestrians.append(pedestrian)
+
+        # expire tracks that went unseen for too long
+        expired = numpy.flatnonzero(self.active & (self.frame_index - self.last_seen > self.ttl))
+        for slot in expired:
+            self.active[slot] = False
+            self.pedestrians[slot] = None
+
+        return matched, new_pedestrians
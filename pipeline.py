@@ -0,0 +1,228 @@
+import threading
+import time
+from collections import deque
+from metrics import metrics
+
+# single-slot buffer that only ever holds the newest value, readers wait for a value newer than the one they last saw,
+# on_drop is called with every value that was replaced before anyone read it
+class LatestValue:
+    def __init__(self, on_drop=None):
+        self.condition = threading.Condition()
+        self.value = None
+        self.sequence = 0
+        self.read_sequence = 0
+        self.overwritten = 0
+        self.closed = False
+        self.on_drop = on_drop
+
+    def put(self, value):
+        dropped = None
+        with self.condition:
+            # the previous value was replaced before anyone read it
+            if self.sequence > self.read_sequence:
+                self.overwritten += 1
+                dropped = self.value
+            self.value = value
+            self.sequence += 1
+            self.condition.notify_all()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    # return (sequence, value) for the first value after sequence "after", or (after, None) on timeout or close
+    def get(self, after=0, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence > after or self.closed, timeout) or self.sequence <= after:
+                return after, None
+            self.read_sequence = self.sequence
+            return self.sequence, self.value
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+# fixed-size FIFO that drops either the oldest queued item or the incoming one when full, instead of blocking the producer,
+# on_drop is called with every dropped item
+class BoundedQueue:
+    def __init__(self, maxsize, drop='oldest', on_drop=None):
+        if drop not in ('oldest', 'newest'):
+            raise ValueError('drop must be "oldest" or "newest"')
+        self.condition = threading.Condition()
+        self.items = deque()
+        self.maxsize = maxsize
+        self.drop = drop
+        self.dropped = 0
+        self.closed = False
+        self.on_drop = on_drop
+
+    def put(self, item):
+        dropped = None
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                self.dropped += 1
+                if self.drop == 'newest':
+                    dropped = item
+                else:
+                    dropped = self.items.popleft()
+            if dropped is not item:
+                self.items.append(item)
+                self.condition.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+        return dropped is not item
+
+    # return the next item, or None on timeout or close
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.items) > 0 or self.closed, timeout) or len(self.items) == 0:
+                return None
+            return self.items.popleft()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+# run capture, inference, tracking and control in their own threads, linked by latest-value slots,
+# the display pulls from a bounded queue on the caller's thread so a slow window never stalls inference,
+# only every display_every-th tracked frame is drawn and queued for display (0 for no display),
+# track may return the frame to display in place of the one it was given, read_frame returns (frame, capture time)
+# on the time.monotonic clock, so frame ages and capture-to-command latency include the time a frame waited for capture,
+# every frame read is handed to release_frame once the pipeline is done with it, when it is dropped, tracked without
+# being displayed, or replaced on the display, so read_frame can lend out pooled buffers instead of copies
+class Pipeline:
+    def __init__(self, read_frame, detect, track, control, control_rate=20, display_queue_size=2, display_every=1, release_frame=None):
+        self.read_frame = read_frame
+        self.detect = detect
+        self.track = track
+        self.control = control
+        self.control_rate = control_rate
+        self.display_every = display_every
+        self.release_frame = (lambda frame: None) if release_frame is None else release_frame
+
+        self.frames = LatestValue(on_drop=lambda item: self.release_frame(item[0]))
+        self.detections = LatestValue(on_drop=lambda item: self.release_frame(item[0]))
+        self.display_frames = BoundedQueue(display_queue_size, drop='oldest', on_drop=self.release_frame)
+        self.displayed_frame = None
+
+        # tracking and control both mutate the vehicles and the control queue
+        self.state_lock = threading.Lock()
+        self.pending_capture_time = None
+        self.command_latencies = deque(maxlen=1000)
+
+        self.counts = {'captured': 0, 'inferred': 0, 'tracked': 0, 'controlled': 0, 'displayed': 0}
+        self.running = False
+        self.start_time = None
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.start_time = time.perf_counter()
+        for target in (self._capture, self._inference, self._tracking, self._control):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        self.frames.close()
+        self.detections.close()
+        self.display_frames.close()
+        for thread in self.threads:
+            thread.join(timeout=1.0)
+
+    # next annotated frame for the display, or None if nothing new arrived in time, the frame stays valid
+    # until a newer one is returned
+    def next_display_frame(self, timeout=None):
+        frame = self.display_frames.get(timeout=timeout)
+        if frame is not None:
+            self.counts['displayed'] += 1
+            if self.displayed_frame is not None:
+                self.release_frame(self.displayed_frame)
+            self.displayed_frame = frame
+        return frame
+
+    def _capture(self):
+        while self.running:
+            frame, capture_time = self.read_frame()
+            if frame is None:
+                break
+            self.frames.put((frame, capture_time))
+            self.counts['captured'] += 1
+
+    def _inference(self):
+        sequence = 0
+        while self.running:
+            sequence, item = self.frames.get(sequence, timeout=0.5)
+            if item is None:
+                continue
+            frame, capture_time = item
+            detections = self.detect(frame)
+            self.detections.put((frame, detections, capture_time))
+            self.counts['inferred'] += 1
+
+    def _tracking(self):
+        sequence = 0
+        while self.running:
+            sequence, item = self.detections.get(sequence, timeout=0.5)
+            if item is None:
+                continue
+            frame, detections, capture_time = item
+            metrics.observe('frame_age', time.monotonic() - capture_time)
+            show = self.display_every > 0 and self.counts['tracked'] % self.display_every == 0
+            with self.state_lock:
+                tracked_frame = self.track(frame, detections, show)
+                self.pending_capture_time = capture_time
+            self.counts['tracked'] += 1
+            # the frame is done with unless it goes on to the display itself
+            if not show or (tracked_frame is not None and tracked_frame is not frame):
+                self.release_frame(frame)
+            if show:
+                self.display_frames.put(frame if tracked_frame is None else tracked_frame)
+
+    # run the controller at a fixed rate, independent of how fast frames arrive
+    def _control(self):
+        period = 1.0 / self.control_rate
+        next_time = time.perf_counter()
+        while self.running:
+            with self.state_lock:
+                self.control()
+                capture_time = self.pending_capture_time
+                self.pending_capture_time = None
+            if capture_time is not None:
+                self.command_latencies.append(time.monotonic() - capture_time)
+                metrics.observe('frame_to_command', self.command_latencies[-1])
+            self.counts['controlled'] += 1
+
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # fell behind, start a fresh schedule instead of running a burst of late ticks
+                next_time = time.perf_counter()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        latencies = sorted(self.command_latencies)
+        return {
+            'elapsed_s': elapsed,
+            'rates': {stage: (self.counts[stage] / elapsed if elapsed > 0 else 0.0) for stage in self.counts},
+            'frames_overwritten': self.frames.overwritten,
+            'detections_overwritten': self.detections.overwritten,
+            'display_dropped': self.display_frames.dropped,
+            'command_latency_ms': {
+                'p50': latencies[len(latencies) // 2] * 1000 if len(latencies) > 0 else 0.0,
+                'p95': latencies[int(len(latencies) * 0.95)] * 1000 if len(latencies) > 0 else 0.0,
+                'max': latencies[-1] * 1000 if len(latencies) > 0 else 0.0,
+            }
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        rates = ', '.join(f'{stage} {rate:.1f}/s' for stage, rate in stats['rates'].items())
+        latency = stats['command_latency_ms']
+        print(f'Pipeline rates: {rates}')
+        print(f'Dropped: {stats["frames_overwritten"]} frames, {stats["detections_overwritten"]} detections, {stats["display_dropped"]} display frames')
+        print(f'Capture-to-command latency (ms): p50 {latency["p50"]:.1f}, p95 {latency["p95"]:.1f}, max {latency["max"]:.1f}')
@@ -0,0 +1,90 @@
+'''*****************************************************************************************
+Fixed-layout binary frames for car telemetry and motor commands, shared by main.py and the
+car firmware (copy this file to the Pico next to ws.py). Runs on CPython and MicroPython.
+
+Every frame starts with a little-endian header: version (u8), kind (u8), sequence (u16),
+timestamp in ms (u32). The ESP8266 bridge forwards text lines, so frames travel as
+BINARY_PREFIX + base64. JSON stays the default until both ends have agreed on binary: the
+car advertises VERSION as 'P' in its JSON telemetry, the host answers with a binary command,
+and the car switches its telemetry to binary once it receives one.
+*****************************************************************************************'''
+import struct
+import time
+
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+
+VERSION = 1
+BINARY_PREFIX = '~'
+
+KIND_TELEMETRY = 1
+KIND_COMMAND = 2
+
+HEADER_FORMAT = '<BBHI'
+# greyscale x3 (u16), speed cm/s (f32), mileage m (f32), sonar angle (i16), sonar distance (f32)
+TELEMETRY_FORMAT = HEADER_FORMAT + '3Hffhf'
+# four motor powers, -100 ~ 100 (i8)
+COMMAND_FORMAT = HEADER_FORMAT + '4b'
+
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+def now_ms():
+    if hasattr(time, 'ticks_ms'):
+        return time.ticks_ms() & 0xFFFFFFFF
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+def pack_telemetry(sequence, greyscale, speed, mileage, sonar_angle, sonar_distance, timestamp=None):
+    if timestamp is None:
+        timestamp = now_ms()
+    return struct.pack(TELEMETRY_FORMAT, VERSION, KIND_TELEMETRY, sequence & 0xFFFF, timestamp,
+                       greyscale[0], greyscale[1], greyscale[2], speed, mileage, int(sonar_angle), sonar_distance)
+
+def pack_command(sequence, motors, timestamp=None):
+    if timestamp is None:
+        timestamp = now_ms()
+    motors = [max(-100, min(100, int(round(power)))) for power in motors]
+    return struct.pack(COMMAND_FORMAT, VERSION, KIND_COMMAND, sequence & 0xFFFF, timestamp,
+                       motors[0], motors[1], motors[2], motors[3])
+
+# return (kind, sequence, timestamp, data), data uses the same keys as the JSON messages
+def unpack(frame):
+    if len(frame) < HEADER_SIZE:
+        raise ValueError('frame too short')
+    version, kind = frame[0], frame[1]
+    if version != VERSION:
+        raise ValueError('unsupported protocol version %d' % version)
+
+    if kind == KIND_TELEMETRY:
+        fields = struct.unpack(TELEMETRY_FORMAT, frame)
+        data = {
+            'A': [fields[4], fields[5], fields[6]],
+            'B': fields[7],
+            'C': fields[8],
+            'D': [fields[9], fields[10]],
+            'E': fields[10]
+        }
+    elif kind == KIND_COMMAND:
+        fields = struct.unpack(COMMAND_FORMAT, frame)
+        data = {'motors': list(fields[4:8])}
+    else:
+        raise ValueError('unknown frame kind %d' % kind)
+    return kind, fields[2], fields[3], data
+
+def is_binary(message):
+    if isinstance(message, (bytes, bytearray)):
+        return len(message) > 0 and message[0] != ord('{') and message[0] != ord('"')
+    return message.startswith(BINARY_PREFIX)
+
+# frame -> text line for the UART / ESP8266 bridge
+def encode_text(frame):
+    return BINARY_PREFIX + binascii.b2a_base64(frame).decode().strip()
+
+# text line or raw websocket bytes -> frame
+def decode_text(message):
+    if isinstance(message, (bytes, bytearray)):
+        if message[:1] == BINARY_PREFIX.encode():
+            return binascii.a2b_base64(message[1:])
+        return bytes(message)
+    return binascii.a2b_base64(message[len(BINARY_PREFIX):])
@@ -1,6 +1,11 @@
 from vehicle import Vehicle
 from pedestrian import Pedestrian
-from datetime import datetime
+import heapq
+import itertools
+import time
+from collections import OrderedDict, deque
+from geometry import SegmentSet
+from metrics import metrics
 
 # map current lane and intended direction to a car's destination lane
 LANE_MAPPINGS = {
@@ -38,94 +43,176 @@ LANE_LINE_MIDPOINTS = {
     'right-backward': (377, 336),
 }
 
-# create ControlQueue, a class for controlling vehicles and lane closures for pedestrians
+# seconds a lane stays closed after a pedestrian starts crossing it
+DEFAULT_CROSSING_DURATION = 15.0
+
+# create ControlQueue, a class for controlling vehicles and lane closures for pedestrians,
+# lane_mappings replaces LANE_MAPPINGS for intersections with a different layout, and a scheduler
+# (see conflicts.py) decides which cars waiting at their stop line may enter, otherwise every one of them goes,
+# clock returns the current time in seconds, simulator.py replaces it with simulated time
 class ControlQueue:
-    def __init__(self):
-        self.queue = []
-        self.crossing_lanes = {
-            'top': False,
-            'bottom': False,
-            'left': False,
-            'right': False
-        }
-        self.started_pedestrians = []
+    def __init__(self, crossing_durations=None, lane_mappings=None, scheduler=None, clock=time.monotonic):
+        # queued objects by id in arrival order, plus the same objects indexed by the lane they are in
+        self.entries = OrderedDict()
+        self.lanes = {}
+        self.entry_lanes = {}
+        self.lane_mappings = LANE_MAPPINGS if lane_mappings is None else lane_mappings
+        self.crossing_lanes = {lane: False for lane in self.lane_mappings}
+        # per-lane crossing durations, and a min-heap of (reopen time, tie breaker, lane) on the monotonic clock
+        self.crossing_durations = {lane: DEFAULT_CROSSING_DURATION for lane in self.crossing_lanes}
+        if crossing_durations is not None:
+            self.crossing_durations.update(crossing_durations)
+        self.crossing_timers = []
+        self.lane_reopen_times = {}
+        self.timer_counter = itertools.count()
+        self.stop_line_source = None
+        self.stop_line_set = None
+        self.scheduler = scheduler
+        self.clock = clock
+
+        # when each car completed its turn over the last minute
+        self.cleared_times = deque()
+        self.cleared = 0
  
+    # snapshot of the queue in arrival order
+    @property
+    def queue(self):
+        return list(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+    # check if an object with this id is queued
+    def __contains__(self, object_id):
+        return object_id in self.entries
+
+    # the lane an object is indexed under, the crosswalk for pedestrians
+    def lane_of(self, object):
+        if isinstance(object, Pedestrian):
+            return object.direction
+        return object.lane
+
+    def _index(self, object):
+        lane = self.lane_of(object)
+        self.entry_lanes[object.id] = lane
+        self.lanes.setdefault(lane, OrderedDict())[object.id] = object
+
+    def _unindex(self, object_id):
+        lane = self.entry_lanes.pop(object_id)
+        del self.lanes[lane][object_id]
+        if len(self.lanes[lane]) == 0:
+            del self.lanes[lane]
+
+    # move a queued object to the back of its new lane's view if its lane changed
+    def update_lane(self, object):
+        if object.id in self.entries and self.entry_lanes[object.id] != self.lane_of(object):
+            self._unindex(object.id)
+            self._index(object)
+
+    # queued objects in a lane, in the order they entered it
+    def lane_view(self, lane):
+        return list(self.lanes.get(lane, {}).values())
+
     # add a car to the queue
     def addCar(self, car, direction):
         car.direction = direction
-        self.queue.append(car)
+        self.remove_object(car)
+        self.entries[car.id] = car
+        self._index(car)
         print(f'Added vehicle "{car.id}" to the queue, moving: "{car.direction}"')
 
     # add a pedestrian to the queue
     def addPedestrian(self, pedestrian, direction):
+        self.remove_object(pedestrian)
         pedestrian.direction = direction
-        self.queue.append(pedestrian)
+        self.entries[pedestrian.id] = pedestrian
+        self._index(pedestrian)
         print(f'Added pedestrian "{pedestrian.id}" to the queue, moving: "{pedestrian.direction}"')
 
     # remove an object from the queue
     def remove(self):
-        if len(self.queue) > 0:
-            self.queue.pop(0)
+        if len(self.entries) > 0:
+            object_id, _ = self.entries.popitem(last=False)
+            self._unindex(object_id)
         else:
             print('Queue removal failed, there is nothing in the queue.')
 
-    def line_intersects_line(self, l1, l2):
-        def ccw(A, B, C):
-            return (C[1] - A[1]) * (B[0] - A[0]) > (B[1] - A[1]) * (C[0] - A[0])
+    # remove a specific object from the queue
+    def remove_object(self, object):
+        if object.id in self.entries:
+            del self.entries[object.id]
+            self._unindex(object.id)
 
-        A, B = l1
-        C, D = l2
-        return ccw(A, C, D) != ccw(B, C, D) and ccw(A, B, C) != ccw(A, B, D)
+    # the object at the front of the queue, or None
+    def head(self):
+        return next(iter(self.entries.values()), None)
 
-    def line_intersects_rect(self, line, rect):
-        x, y, w, h = rect
+    # stop lines as arrays, rebuilt only when a different stop line layout is passed in
+    def stop_line_segments(self, stop_lines):
+        if stop_lines is not self.stop_line_source:
+            self.stop_line_set = SegmentSet(stop_lines)
+            self.stop_line_source = stop_lines
+        return self.stop_line_set
 
-        # Define the four sides of the rectangle
-        rect_lines = [
-            [(x, y), (x + w, y)],
-            [(x, y), (x, y + h)],
-            [(x + w, y), (x + w, y + h)],
-            [(x, y + h), (x + w, y + h)],
-        ]
-
-        # If the line intersects any side of the rectangle, return True
-        for rect_line in rect_lines:
-            if self.line_intersects_line(line, rect_line):
-                return True
-
-        # If we haven't returned yet, the line doesn't intersect the rectangle
-        return False
+    # (cars, stop lines) matrix of which car's contour touches which stop line, in one batched test
+    def stop_line_contacts(self, cars, stop_lines):
+        return self.stop_line_segments(stop_lines).touching([car.contour for car in cars])
 
     # detect if the car is intersection with a lane's stop line
     def intersection_with_stop_line(self, car, stop_lines):
-        for stop_line_key in stop_lines:
-            stop_line = stop_lines[stop_line_key]
-            if self.line_intersects_rect(stop_line, car.contour):
-                return True
-        return False
+        return bool(self.stop_line_contacts([car], stop_lines).any())
 
-    # close a lane if a pedestrian is crossing
+    # close a lane if a pedestrian is crossing, and schedule when it reopens
     def pedestrian_crossing(self, pedestrian):
-        self.crossing_lanes[pedestrian.direction] = True
-        print('lane ' + str(pedestrian.direction) + ' closed')
-        pedestrian.start_time = datetime.now()
-        self.started_pedestrians.append(pedestrian)
-    
+        lane = pedestrian.direction
+        self.crossing_lanes[lane] = True
+        print('lane ' + str(lane) + ' closed')
+        metrics.increment('lane_closures_total', labels={'lane': lane})
+        pedestrian.start_time = self.clock()
+
+        # a lane reopens when the last pedestrian crossing it is done
+        reopen_time = pedestrian.start_time + self.crossing_durations.get(lane, DEFAULT_CROSSING_DURATION)
+        if reopen_time > self.lane_reopen_times.get(lane, 0.0):
+            self.lane_reopen_times[lane] = reopen_time
+            heapq.heappush(self.crossing_timers, (reopen_time, next(self.timer_counter), lane))
+
+    # monotonic time of the next lane reopening, or None when no lane is closed
+    def next_reopen_time(self):
+        return self.crossing_timers[0][0] if len(self.crossing_timers) > 0 else None
+
     # control lane closures, and when to reopen a lane
     def control_pedestrians(self):
 
         # if there is a pedestrian in the queue, perform a crossing and remove that pedestrian
-        while len(self.queue) > 0 and isinstance(self.queue[0], Pedestrian):
-            self.pedestrian_crossing(self.queue[0])
-            print('Removing Pedestrian', self.queue[0].id)
-            self.queue.pop(0)
-        
-        # if 15 seconds have passed, reopen the lane 
-        for started_pedestrian in self.started_pedestrians:
-            if (datetime.now() - started_pedestrian.start_time).total_seconds() >= 15.0:
-                print('lane ' + str(started_pedestrian.direction) + ' open')
-                self.crossing_lanes[started_pedestrian.direction] = False
-                self.started_pedestrians.remove(started_pedestrian)
+        while isinstance(self.head(), Pedestrian):
+            self.pedestrian_crossing(self.head())
+            print('Removing Pedestrian', self.head().id)
+            self.remove()
+
+        # reopen lanes whose crossing time has passed, only the expired timers at the top of the heap are touched
+        now = self.clock()
+        while len(self.crossing_timers) > 0 and self.crossing_timers[0][0] <= now:
+            reopen_time, _, lane = heapq.heappop(self.crossing_timers)
+            # skip timers superseded by a later pedestrian on the same lane
+            if self.lane_reopen_times.get(lane) == reopen_time:
+                print('lane ' + str(lane) + ' open')
+                self.crossing_lanes[lane] = False
+                del self.lane_reopen_times[lane]
+
+    # cars that completed their turn over the last minute
+    def cleared_per_minute(self, now=None):
+        now = self.clock() if now is None else now
+        while len(self.cleared_times) > 0 and self.cleared_times[0] <= now - 60.0:
+            self.cleared_times.popleft()
+        return len(self.cleared_times)
+
+    # count a car that reached its destination lane as cleared, once
+    def complete_turn(self, car):
+        if not car.completed_turn:
+            self.cleared_times.append(self.clock())
+            self.cleared += 1
+            metrics.increment('vehicles_cleared_total')
+        car.completed_turn = True
 
     # control the lane closures and cars' movements
     def control(self, stop_lines):
@@ -135,50 +222,68 @@ class ControlQueue:
     # control the cars turning
     def control_cars(self, stop_lines):
 
-        # iterate through the queue
-        for object in self.queue:
-            # ensure that the object is a car
+        cars = []
+        for object in self.entries.values():
             if isinstance(object, Vehicle):
-                car = object
-
-                # if the car is in a backward lane
-                #if 'backward' in car.lane and car.turning != True:
-                 #   car.direction_to_motor_power('forward', 1)
-                  #  continue
-
-                if car.lane != 'Undefined':
-                    at_stop_line = self.intersection_with_stop_line(car, stop_lines)
-
-                    # if the car's intended turn has been declared, but it does not yet have a destination lane, give the car a lane
-                    if car.stop_lane == '':
-                        car.stop_lane = LANE_MAPPINGS[car.lane.split('-')[0]][car.direction]
-                    
-                    # do not allow car to move if the crosswalk in front of the car is currently occupied
-                    if self.crossing_lanes[car.lane.split('-')[0]] or self.crossing_lanes[car.stop_lane.split('-')[0]]:
-                        car.direction_to_motor_power('forward', 0)
-                        self.turning = False
-
-                    # if the car is in the intersection and has not reached its destination lane
-                    elif at_stop_line == True and car.lane != car.stop_lane:
-                        if car.direction == 'forward':
-                            car.direction_to_motor_power('forward', 100)
-                        if car.direction == 'right':
-                            car.direction_to_motor_power('right', 100)
-                        if car.direction == 'left':
-                            car.direction_to_motor_power('left', 100)
-                        car.turning = True
-
-                    # if the car has reached its destination lane and completed its turn
-                    elif car.lane == car.stop_lane:
-                        car.completed_turn = True
-                        if car.is_visible == True:
-                            car.direction_to_motor_power('forward', 55)
-                        # if the camera could not detect the car, stop the car
-                        else:
-                            print('car is not visible')
-                            car.direction_to_motor_power('forward', 0)
-                            self.queue.remove(car)
-                        self.turning = False
-                    
-                    else:
-                        car.direction_to_motor_power('forward', 55)
\ No newline at end of file
+                self.update_lane(object)
+                if object.lane != 'Undefined':
+                    cars.append(object)
+
+        # every car is tested against every stop line in one batched call, lane order is the order cars were
+        # seen in a lane, not where they are in it, so no car can be assumed to be away from its stop line
+        at_stop_lines = self.stop_line_contacts(cars, stop_lines).any(axis=1).tolist()
+
+        # if the car's intended turn has been declared, but it does not yet have a destination lane, give the car a lane
+        for car in cars:
+            if car.stop_lane == '':
+                car.stop_lane = self.lane_mappings[car.lane.split('-')[0]][car.direction]
+
+        # let every car at its stop line whose movement fits alongside the ones already in the intersection go at once
+        released = None
+        if self.scheduler is not None:
+            waiting = [car.id for car, at_stop_line in zip(cars, at_stop_lines) if at_stop_line and car.lane != car.stop_lane]
+            released = self.scheduler.release([object for object in self.entries.values() if isinstance(object, Vehicle)], waiting, self.crossing_lanes, self.clock())
+
+        # iterate through the cars in the queue
+        for car, at_stop_line in zip(cars, at_stop_lines):
+            # if the car is in a backward lane
+            #if 'backward' in car.lane and car.turning != True:
+             #   car.direction_to_motor_power('forward', 1)
+              #  continue
+
+            # do not allow car to move if the crosswalk in front of the car is currently occupied
+            if self.crossing_lanes[car.lane.split('-')[0]] or self.crossing_lanes[car.stop_lane.split('-')[0]]:
+                car.direction_to_motor_power('forward', 0)
+                self.turning = False
+                # a car held in its destination lane has still completed its turn
+                if car.lane == car.stop_lane:
+                    self.complete_turn(car)
+
+            # hold the car at its stop line until its movement no longer conflicts with the traffic inside
+            elif at_stop_line == True and car.lane != car.stop_lane and released is not None and car.id not in released:
+                car.direction_to_motor_power('forward', 0)
+
+            # if the car is in the intersection and has not reached its destination lane
+            elif at_stop_line == True and car.lane != car.stop_lane:
+                if car.direction == 'forward':
+                    car.direction_to_motor_power('forward', 100)
+                if car.direction == 'right':
+                    car.direction_to_motor_power('right', 100)
+                if car.direction == 'left':
+                    car.direction_to_motor_power('left', 100)
+                car.turning = True
+
+            # if the car has reached its destination lane and completed its turn
+            elif car.lane == car.stop_lane:
+                self.complete_turn(car)
+                if car.is_visible == True:
+                    car.direction_to_motor_power('forward', 55)
+                # if the camera could not detect the car, stop the car
+                else:
+                    print('car is not visible')
+                    car.direction_to_motor_power('forward', 0)
+                    self.remove_object(car)
+                self.turning = False
+            
+            else:
+                car.direction_to_motor_power('forward', 55)
\ No newline at end of file
@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import time
+import cv2
+import numpy
+import main
+from detector import BACKENDS
+from kalman import PredictiveDetector
+from motion_gate import GatedDetector
+from metrics import metrics
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+# yield frames from a recorded video file, or from a directory of still frames in name order
+def read_frames(source):
+    if os.path.isdir(source):
+        for file_name in sorted(os.listdir(source)):
+            if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                frame = cv2.imread(os.path.join(source, file_name))
+                if frame is not None:
+                    yield frame
+    else:
+        capture = cv2.VideoCapture(source)
+        if not capture.isOpened():
+            raise ValueError(f'Could not open replay source "{source}"')
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            yield frame
+        capture.release()
+
+# stand-in for a car's websocket that records every command instead of sending it
+class StubSocket:
+    def __init__(self, car):
+        self.car = car
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+# feed recorded frames through the same resize, detect and control path as main(), without a camera or cars
+def replay(source, limit=None, warmup=0):
+    sockets = {car_key: StubSocket(main.cars[car_key]) for car_key in main.cars}
+    last_speeds = {car_key: list(main.cars[car_key].motor_speeds) for car_key in main.cars}
+    latencies = []
+    commands = []
+    detection_count = 0
+    frame_index = -1
+    start_time = None
+
+    for frame_index, frame in enumerate(read_frames(source)):
+        if limit is not None and frame_index >= limit + warmup:
+            break
+        if frame_index == warmup:
+            start_time = time.perf_counter()
+
+        frame_start = time.perf_counter()
+        frame = cv2.resize(frame, (640, 640))
+        detections = main.detect(frame)
+        main.process_frame(frame, detections, draw=False)
+
+        # a car only gets a new command when the controller changed its motor speeds
+        for car_key in main.cars:
+            motor_speeds = main.cars[car_key].motor_speeds
+            if motor_speeds != last_speeds[car_key]:
+                sockets[car_key].send(json.dumps({"motors": motor_speeds}))
+                commands.append({'frame': frame_index, 'car': car_key, 'motors': list(motor_speeds)})
+                last_speeds[car_key] = list(motor_speeds)
+
+        if frame_index >= warmup:
+            latencies.append(time.perf_counter() - frame_start)
+            detection_count += len(detections)
+
+    elapsed = time.perf_counter() - start_time if start_time is not None else 0.0
+    latencies_ms = numpy.array(latencies) * 1000
+
+    return {
+        'source': source,
+        'frames': len(latencies),
+        'warmup_frames': min(warmup, frame_index + 1),
+        'elapsed_s': elapsed,
+        'fps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'latency_ms': {
+            'mean': float(latencies_ms.mean()) if len(latencies) > 0 else 0.0,
+            'p50': float(numpy.percentile(latencies_ms, 50)) if len(latencies) > 0 else 0.0,
+            'p95': float(numpy.percentile(latencies_ms, 95)) if len(latencies) > 0 else 0.0,
+            'p99': float(numpy.percentile(latencies_ms, 99)) if len(latencies) > 0 else 0.0,
+        },
+        'detections': detection_count,
+        'commands_sent': {car_key: len(sockets[car_key].sent) for car_key in sockets},
+        'commands': commands,
+        'tracking': stage_stats(PredictiveDetector),
+        'motion_gate': stage_stats(GatedDetector),
+        'stages': metrics.snapshot()['stages']
+    }
+
+# stats of the first detector stage of a given type, or None when that stage is not in use
+def stage_stats(stage_type):
+    for stage in main.detector_chain(main.detector):
+        if isinstance(stage, stage_type):
+            return stage.stats()
+    return None
+
+def print_report(report):
+    latency = report['latency_ms']
+    print(f'Replayed {report["frames"]} frames from "{report["source"]}" ({report["warmup_frames"]} warm-up frames skipped)')
+    print(f'Throughput: {report["fps"]:.2f} frames/s over {report["elapsed_s"]:.2f} s')
+    print(f'Frame latency (ms): mean {latency["mean"]:.2f}, p50 {latency["p50"]:.2f}, p95 {latency["p95"]:.2f}, p99 {latency["p99"]:.2f}')
+    print(f'Detections: {report["detections"]}')
+    if report['tracking'] is not None:
+        tracking = report['tracking']
+        print(f'Detector ran on {tracking["detector_runs"]} frames, predicted {tracking["predicted_frames"]}, drift mean {tracking["drift_px"]["mean"]:.1f} px, p95 {tracking["drift_px"]["p95"]:.1f} px')
+    if report['motion_gate'] is not None:
+        gate = report['motion_gate']
+        print(f'Motion gate skipped {gate["skipped"]} of {gate["frames"]} frames ({gate["skip_rate"] * 100:.1f}%)')
+    for stage, stage_latency in sorted(report['stages'].items()):
+        print(f'Stage {stage}: {stage_latency["count"]} calls, mean {stage_latency["mean_ms"]:.2f} ms, p95 <= {stage_latency["p95_ms"]:.2f} ms')
+    for car_key in report['commands_sent']:
+        print(f'Commands sent to "{car_key}": {report["commands_sent"][car_key]}')
+    for command in report['commands']:
+        print(f'  frame {command["frame"]}: {command["car"]} -> {command["motors"]}')
+
+def parse_device(device):
+    return int(device) if device.isdigit() else device
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded frames through the vision and control loop and report its performance.')
+    parser.add_argument('source', help='video file or directory of frames')
+    parser.add_argument('--backend', default='onnx', choices=BACKENDS, help='detector backend')
+    parser.add_argument('--device', default='cpu', help='inference device for the ultralytics backend, e.g. "cpu" or a CUDA index such as 0')
+    parser.add_argument('--threads', type=int, default=None, help='CPU runtime threads, defaults to the available cores')
+    parser.add_argument('--detect-every', type=int, default=1, help='run the model every N frames and predict boxes in between')
+    parser.add_argument('--no-motion-gate', action='store_true', help='run the model on every frame, even when nothing moved')
+    parser.add_argument('--limit', type=int, default=None, help='maximum number of measured frames')
+    parser.add_argument('--warmup', type=int, default=5, help='frames to run before measuring')
+    parser.add_argument('--json', dest='json_path', default=None, help='also write the report to this file')
+    args = parser.parse_args()
+
+    main.detect_every = args.detect_every
+    main.motion_gating = not args.no_motion_gate
+    main.detector = main.build_detector(args.backend, device=parse_device(args.device), threads=args.threads)
+    report = replay(args.source, limit=args.limit, warmup=args.warmup)
+    print_report(report)
+    if args.json_path is not None:
+        with open(args.json_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
@@ -0,0 +1,366 @@
+import argparse
+import json
+import math
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+import numpy
+from vehicle import Vehicle
+from pedestrian import Pedestrian
+from queuing import ControlQueue, LANE_MAPPINGS, LANE_LINE_MIDPOINTS
+from conflicts import ConflictScheduler, conflict_matrix, movements
+from lane_map import LaneMap, UNDEFINED
+from intersection import load_config
+
+# pixels per second a car covers at motor power 100
+FULL_SPEED = 80.0
+CAR_SIZE = 20
+# closest a car follows the one ahead in its approach lane, in pixels along the path
+FOLLOWING_GAP = 28.0
+
+# simulated time, shared with the control queue so lane closures and waits run on it instead of the wall clock
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+# one intersection's geometry from an intersections config file, the first intersection unless one is named
+class Layout:
+    def __init__(self, config, name=None):
+        entries = config['intersections']
+        entry = entries[0] if name is None else next(entry for entry in entries if entry['name'] == name)
+        self.name = entry['name']
+        self.lanes = {lane: [tuple(point) for point in line] for lane, line in entry['lanes'].items()}
+        self.stop_lines = {approach: [tuple(point) for point in line] for approach, line in entry['stop_lines'].items()}
+        self.lane_mappings = entry.get('lane_mappings', LANE_MAPPINGS)
+        self.midpoints = {lane: tuple(point) for lane, point in entry.get('lane_line_midpoints', LANE_LINE_MIDPOINTS).items()}
+        self.scheduler_settings = {key: entry[key] for key in ('compatibility_bonus', 'max_wait', 'max_crossing') if key in entry}
+
+# the centerline of a lane as its (inner, outer) endpoints, the inner one nearest the intersection,
+# lanes are the two opposite corners of a straight lane
+def lane_centerline(lane, midpoint):
+    (x1, y1), (x2, y2) = lane
+    center_x, center_y = (x1 + x2) / 2, (y1 + y2) / 2
+    if abs(y2 - y1) > abs(x2 - x1):
+        ends = [(center_x, y1), (center_x, y2)]
+    else:
+        ends = [(x1, center_y), (x2, center_y)]
+    ends.sort(key=lambda end: (end[0] - midpoint[0]) ** 2 + (end[1] - midpoint[1]) ** 2)
+    return ends
+
+# a movement's path through the layout as a polyline: in along the approach lane to its stop line, across to
+# the destination lane's stop line and out along the destination lane, plus where the stop line is on it
+class Path:
+    def __init__(self, points, stop_distance):
+        self.points = numpy.array(points, dtype=numpy.float64)
+        segment_lengths = numpy.hypot(*numpy.diff(self.points, axis=0).T)
+        self.distances = numpy.concatenate(([0.0], numpy.cumsum(segment_lengths)))
+        self.length = self.distances[-1]
+        self.stop_distance = stop_distance
+
+    # (n, 2) positions at distances s along the path
+    def positions(self, s):
+        x = numpy.interp(s, self.distances, self.points[:, 0])
+        y = numpy.interp(s, self.distances, self.points[:, 1])
+        return numpy.stack((x, y), axis=1)
+
+def build_paths(lanes, lane_mappings=LANE_MAPPINGS, midpoints=LANE_LINE_MIDPOINTS):
+    paths = {}
+    for approach, turn in movements(lane_mappings):
+        entry_lane = approach + '-forward'
+        exit_lane = lane_mappings[approach][turn]
+        entry_inner, entry_outer = lane_centerline(lanes[entry_lane], midpoints[entry_lane])
+        exit_inner, exit_outer = lane_centerline(lanes[exit_lane], midpoints[exit_lane])
+        stop = midpoints[entry_lane]
+        points = [entry_outer, stop, midpoints[exit_lane], exit_outer]
+        paths[(approach, turn)] = Path(points, numpy.hypot(stop[0] - entry_outer[0], stop[1] - entry_outer[1]))
+    return paths
+
+# lane and approach names of one copy of the layout, "<tile>:top-forward" and so on, so the copies share one
+# control queue and scheduler without their lanes, stop lines and crosswalks running into each other
+def tile_name(tile, name):
+    return f'{tile}:{name}'
+
+# drive synthetic cars and pedestrians through `intersections` copies of a layout, tiled side by side on one
+# plane and all controlled by a single ControlQueue, in fixed time steps, every step the cars' lanes are looked up
+# from their boxes and ControlQueue.control(stop_lines) runs exactly as in main(), then each car moves along its
+# movement's path at the speed its motor_speeds give, cars arrive at arrival_rate per minute per approach
+# and wait in a backlog while their lane's entrance is occupied
+class Simulator:
+    def __init__(self, layout, intersections=1, arrival_rate=6.0, pedestrian_rate=0.5, turns=('forward', 'right', 'left'),
+                 scheduling=True, dt=0.05, seed=0, size=(640, 640)):
+        self.layout = layout
+        self.intersections = intersections
+        self.arrival_rate = arrival_rate
+        self.pedestrian_rate = pedestrian_rate
+        self.turns = turns
+        self.dt = dt
+        self.rng = numpy.random.default_rng(seed)
+
+        # tiles fill a square grid, each one the size of the camera frame
+        columns = math.ceil(math.sqrt(intersections))
+        self.offsets = numpy.array([((tile % columns) * size[0], (tile // columns) * size[1]) for tile in range(intersections)], dtype=numpy.float64)
+        self.lane_map = LaneMap(layout.lanes, size=size)
+        self.paths = build_paths(layout.lanes, layout.lane_mappings, layout.midpoints)
+        self.local_approaches = list(layout.lane_mappings)
+
+        lane_mappings = {}
+        midpoints = {}
+        self.stop_lines = {}
+        for tile, (x, y) in enumerate(self.offsets):
+            for approach, turns_to in layout.lane_mappings.items():
+                lane_mappings[tile_name(tile, approach)] = {turn: tile_name(tile, lane) for turn, lane in turns_to.items()}
+            for lane, (mid_x, mid_y) in layout.midpoints.items():
+                midpoints[tile_name(tile, lane)] = (int(mid_x + x), int(mid_y + y))
+            for approach, line in layout.stop_lines.items():
+                self.stop_lines[tile_name(tile, approach)] = [(int(px + x), int(py + y)) for px, py in line]
+
+        self.clock = SimulatedClock()
+        self.scheduler = ConflictScheduler(lane_mappings, midpoints, **layout.scheduler_settings) if scheduling else None
+        self.control_queue = ControlQueue(lane_mappings=lane_mappings, scheduler=self.scheduler, clock=self.clock)
+        self.approaches = list(lane_mappings)
+        self.movement_index = {movement: index for index, movement in enumerate(movements(lane_mappings))}
+        self.conflicts = conflict_matrix(lane_mappings, midpoints)
+
+        # cars on the map, their tile and local movement, distance along its path and arrival time
+        self.cars = []
+        self.tiles = []
+        self.car_movements = []
+        self.distances = []
+        self.arrivals = []
+        self.backlog = {(tile, approach): [] for tile in range(intersections) for approach in self.local_approaches}
+
+        self.spawned = 0
+        self.cleared = 0
+        self.exited = 0
+        self.pedestrians = 0
+        self.peak_queue = 0
+        self.waits = []
+        self.control_times = []
+        self.conflict_ticks = 0
+        self.ticks = 0
+
+    # indices of the cars in each (tile, approach) lane that have not crossed its stop line yet
+    def approach_queues(self):
+        queues = {}
+        for index, (tile, movement, distance) in enumerate(zip(self.tiles, self.car_movements, self.distances)):
+            if distance <= self.paths[movement].stop_distance:
+                queues.setdefault((tile, movement[0]), []).append(index)
+        return queues
+
+    def spawn(self):
+        # Poisson arrivals per approach and pedestrians over one step
+        counts = self.rng.poisson(self.arrival_rate / 60.0 * self.dt, size=len(self.backlog))
+        for key, count in zip(self.backlog, counts):
+            self.backlog[key].extend([self.clock.now] * count)
+        for _ in range(self.rng.poisson(self.pedestrian_rate * self.intersections / 60.0 * self.dt)):
+            pedestrian = Pedestrian({'id': f'pedestrian-{self.pedestrians}'})
+            self.pedestrians += 1
+            self.control_queue.addPedestrian(pedestrian, self.approaches[self.rng.integers(len(self.approaches))])
+
+        # the lane entrance must be clear of the last car that entered it
+        last_entered = {key: min(self.distances[index] for index in indices) for key, indices in self.approach_queues().items()}
+        for (tile, approach), backlog in self.backlog.items():
+            if len(backlog) == 0 or last_entered.get((tile, approach), FOLLOWING_GAP) < FOLLOWING_GAP:
+                continue
+            turn = self.turns[self.rng.integers(len(self.turns))]
+            car = Vehicle({'id': f'car-{self.spawned}', 'color': [0, 0, 0]})
+            car.is_visible = True
+            self.spawned += 1
+            self.cars.append(car)
+            self.tiles.append(tile)
+            self.car_movements.append((approach, turn))
+            self.distances.append(0.0)
+            self.arrivals.append(backlog.pop(0))
+            self.control_queue.addCar(car, turn)
+
+    # every car's box at its place on its path, and the lane that box is in
+    def locate(self):
+        if len(self.cars) == 0:
+            return
+        contours = numpy.empty((len(self.cars), 4), dtype=numpy.int64)
+        groups = {}
+        for index, movement in enumerate(self.car_movements):
+            groups.setdefault(movement, []).append(index)
+        for movement, indices in groups.items():
+            positions = self.paths[movement].positions(numpy.array([self.distances[index] for index in indices]))
+            contours[indices, 0] = positions[:, 0] - CAR_SIZE / 2
+            contours[indices, 1] = positions[:, 1] - CAR_SIZE / 2
+        contours[:, 2:] = CAR_SIZE
+        # every tile has the same geometry, so lanes are looked up in tile coordinates
+        lanes, _ = self.lane_map.assign(contours)
+        contours[:, :2] += self.offsets[self.tiles].astype(numpy.int64)
+        for car, tile, contour, lane in zip(self.cars, self.tiles, contours.tolist(), lanes):
+            car.contour = contour
+            car.previous_lane = car.lane
+            car.lane = lane if lane == UNDEFINED else tile_name(tile, lane)
+            self.control_queue.update_lane(car)
+
+    # move every car by its commanded speed, never closer than FOLLOWING_GAP to the car ahead in its approach lane
+    def advance(self):
+        speeds = [max(sum(car.motor_speeds) / 4 / 100 * FULL_SPEED * self.dt, 0.0) for car in self.cars]
+        queued = set()
+        for indices in self.approach_queues().values():
+            # nearest the stop line first
+            indices.sort(key=lambda index: -self.distances[index])
+            limit = None
+            for index in indices:
+                distance = self.distances[index] + speeds[index]
+                if limit is not None:
+                    distance = min(distance, max(limit, self.distances[index]))
+                self.distances[index] = distance
+                limit = distance - FOLLOWING_GAP
+            queued.update(indices)
+        # past the stop line cars only follow their own path
+        for index in range(len(self.cars)):
+            if index not in queued:
+                self.distances[index] += speeds[index]
+
+    # count steps where cars with conflicting movements are inside an intersection together
+    def check_conflicts(self):
+        inside = [self.movement_index[(tile_name(tile, movement[0]), movement[1])]
+                  for tile, movement, distance, car in zip(self.tiles, self.car_movements, self.distances, self.cars)
+                  if distance > self.paths[movement].stop_distance and not car.completed_turn]
+        if len(inside) > 1 and self.conflicts[numpy.ix_(inside, inside)].any():
+            self.conflict_ticks += 1
+
+    # drop cars that left the map, and record the ones that completed their turn
+    def retire(self):
+        keep = []
+        for index, car in enumerate(self.cars):
+            movement = self.car_movements[index]
+            if car.completed_turn and not getattr(car, 'counted', False):
+                car.counted = True
+                self.cleared += 1
+                self.waits.append(self.clock.now - self.arrivals[index])
+            if self.distances[index] >= self.paths[movement].length:
+                self.control_queue.remove_object(car)
+                self.exited += 1
+                continue
+            keep.append(index)
+        self.cars = [self.cars[index] for index in keep]
+        self.tiles = [self.tiles[index] for index in keep]
+        self.car_movements = [self.car_movements[index] for index in keep]
+        self.distances = [self.distances[index] for index in keep]
+        self.arrivals = [self.arrivals[index] for index in keep]
+
+    def step(self):
+        self.spawn()
+        self.locate()
+        self.peak_queue = max(self.peak_queue, len(self.control_queue))
+
+        start = time.perf_counter()
+        self.control_queue.control(self.stop_lines)
+        self.control_times.append(time.perf_counter() - start)
+
+        self.advance()
+        self.check_conflicts()
+        self.retire()
+        self.clock.now += self.dt
+        self.ticks += 1
+
+    # run for `duration` simulated seconds, tracing allocations slows every step down several times,
+    # so trace_memory is for a separate run whose timings are not reported
+    def run(self, duration, trace_memory=False):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        # the control queue reports every car and lane change on stdout
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            while self.clock.now < duration:
+                self.step()
+        elapsed = time.perf_counter() - start
+        peak_memory = None
+        if trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return self.report(elapsed, peak_memory)
+
+    def report(self, elapsed, peak_memory=None):
+        control_ms = numpy.array(self.control_times) * 1000
+        waits = numpy.array(self.waits)
+        minutes = self.clock.now / 60.0
+        return {
+            'simulated_s': self.clock.now,
+            'wall_s': elapsed,
+            'speedup': self.clock.now / elapsed if elapsed > 0 else 0.0,
+            'ticks': self.ticks,
+            'intersections': self.intersections,
+            'scheduling': self.scheduler is not None,
+            'spawned': self.spawned,
+            'peak_queue': self.peak_queue,
+            'backlog': sum(len(backlog) for backlog in self.backlog.values()),
+            'pedestrians': self.pedestrians,
+            'cleared': self.cleared,
+            'cleared_per_minute': self.cleared / minutes if minutes > 0 else 0.0,
+            'wait_s': {
+                'mean': float(waits.mean()) if len(waits) > 0 else 0.0,
+                'p95': float(numpy.percentile(waits, 95)) if len(waits) > 0 else 0.0,
+                'max': float(waits.max()) if len(waits) > 0 else 0.0
+            },
+            'control_ms': {
+                'mean': float(control_ms.mean()) if len(control_ms) > 0 else 0.0,
+                'p95': float(numpy.percentile(control_ms, 95)) if len(control_ms) > 0 else 0.0,
+                'max': float(control_ms.max()) if len(control_ms) > 0 else 0.0
+            },
+            'conflict_ticks': self.conflict_ticks,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3,
+            'peak_traced_mb': peak_memory / 1e6 if peak_memory is not None else None,
+            'scheduler': self.scheduler.stats() if self.scheduler is not None else None
+        }
+
+def print_report(report):
+    print(f'Simulated {report["simulated_s"]:.0f} s in {report["wall_s"]:.2f} s ({report["speedup"]:.0f}x real time, {report["ticks"]} ticks)')
+    print(f'Intersections: {report["intersections"]}, conflict scheduling: {"on" if report["scheduling"] else "off"}')
+    print(f'Cars: {report["spawned"]} spawned, {report["cleared"]} cleared, {report["backlog"]} still waiting to enter; {report["pedestrians"]} pedestrians')
+    print(f'Control queue: up to {report["peak_queue"]} entries')
+    print(f'Throughput: {report["cleared_per_minute"]:.1f} cars/min')
+    wait = report['wait_s']
+    print(f'Wait from arrival to clearing (s): mean {wait["mean"]:.1f}, p95 {wait["p95"]:.1f}, max {wait["max"]:.1f}')
+    control = report['control_ms']
+    print(f'Controller time per tick (ms): mean {control["mean"]:.3f}, p95 {control["p95"]:.3f}, max {control["max"]:.3f}')
+    print(f'Ticks with conflicting cars inside an intersection: {report["conflict_ticks"]}')
+    print(f'Peak RSS: {report["peak_rss_mb"]:.1f} MB')
+    if report['peak_traced_mb'] is not None:
+        print(f'Peak traced memory (separate run): {report["peak_traced_mb"]:.1f} MB')
+    if report['scheduler'] is not None:
+        scheduler = report['scheduler']
+        print(f'Scheduler: released {scheduler["released"]} cars after {scheduler["mean_wait_s"]:.1f} s at the stop line on average, {scheduler["max_wait_s"]:.1f} s at most')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive the intersection controller with simulated cars and pedestrians and report its performance.')
+    parser.add_argument('--layout', default='./data/intersections.json', help='intersections config file to take the geometry from')
+    parser.add_argument('--intersection', default=None, help='name of the intersection in the layout file, the first one by default')
+    parser.add_argument('--intersections', type=int, default=1, help='copies of the intersection sharing one control queue, to load it with thousands of cars')
+    parser.add_argument('--duration', type=float, default=600.0, help='simulated seconds')
+    parser.add_argument('--dt', type=float, default=0.05, help='seconds per tick')
+    parser.add_argument('--arrival-rate', type=float, default=6.0, help='cars per minute on each approach')
+    parser.add_argument('--pedestrian-rate', type=float, default=0.5, help='pedestrians per minute per intersection')
+    parser.add_argument('--no-scheduling', action='store_true', help='let every car at a stop line go, as without a scheduler')
+    parser.add_argument('--trace-memory', action='store_true', help='repeat the run under tracemalloc to report peak traced memory')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', action='store_true', help='exit with status 1 if the scheduler ever let conflicting cars into an intersection together')
+    parser.add_argument('--json', dest='json_path', default=None, help='also write the report to this file')
+    args = parser.parse_args()
+
+    layout = Layout(load_config(args.layout), args.intersection)
+    def simulator():
+        return Simulator(layout, intersections=args.intersections, arrival_rate=args.arrival_rate, pedestrian_rate=args.pedestrian_rate,
+                         scheduling=not args.no_scheduling, dt=args.dt, seed=args.seed)
+
+    report = simulator().run(args.duration)
+    if args.trace_memory:
+        report['peak_traced_mb'] = simulator().run(args.duration, trace_memory=True)['peak_traced_mb']
+    print_report(report)
+    if args.json_path is not None:
+        with open(args.json_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    if args.check and report['scheduling'] and report['conflict_ticks'] > 0:
+        print(f'Check failed: {report["conflict_ticks"]} ticks with conflicting cars inside an intersection')
+        sys.exit(1)
@@ -0,0 +1,163 @@
+import argparse
+import multiprocessing
+import queue
+import signal
+import time
+from detector import build_detector, available_cores, DEFAULT_BACKEND
+from video_capture import VideoCapture
+from pipeline import Pipeline
+from metrics import metrics
+from intersection import intersection_from_config, load_config, all_car_configs
+
+# the model for one intersection with its config's backend, frame skipping and motion gating, the same defaults as main.py
+def intersection_detector(config, threads=None):
+    return build_detector(config.get('detector_backend', DEFAULT_BACKEND), config.get('model_path', './data/model.pt'),
+                          device=config.get('device', 0), threads=threads, detect_every=config.get('detect_every', 1),
+                          redetect_confidence=config.get('redetect_confidence', 0.6), motion_gating=config.get('motion_gating', True))
+
+# one intersection's process: its own camera, model, controller and car connections, cars handed over by the
+# supervisor arrive on inbox and cars leaving through an exit lane are posted to outbox
+def run_worker(config, all_cars, cars, inbox, outbox, threads=None, metrics_port=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    intersection = intersection_from_config(config, all_cars=all_cars, cars_override=cars)
+    detector = intersection_detector(config, threads=threads)
+    camera = VideoCapture(config.get('camera_source', 0), width=config.get('camera_width', 1920), height=config.get('camera_height', 1080),
+                          backend=config.get('camera_backend'), output_size=(640, 640))
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+
+    # runs on the pipeline's control thread under its state lock, so handoffs never race the tracker
+    def control():
+        while True:
+            try:
+                handoff = inbox.get_nowait()
+            except queue.Empty:
+                break
+            intersection.adopt(handoff['car'], handoff['direction'])
+        intersection.control_step()
+        for handoff in intersection.departures():
+            outbox.put(('handoff', config['name'], handoff))
+
+    intersection.fleet.start()
+    pipeline = Pipeline(lambda: camera.read_timestamped(hold=True),
+                        detector.detect,
+                        lambda frame, detections, draw: intersection.process_frame(frame, detections, control=False, draw=False),
+                        control,
+                        control_rate=config.get('control_rate', 20),
+                        display_every=0,
+                        release_frame=camera.release_frame)
+    pipeline.start()
+
+    # the capture thread ends when the camera stops
+    while pipeline.threads[0].is_alive():
+        time.sleep(0.5)
+
+    pipeline.stop()
+    intersection.fleet.stop()
+    print(f'Intersection "{config["name"]}" stopped')
+    pipeline.print_stats()
+    intersection.fleet.print_stats()
+    camera.release()
+
+# run every intersection of a config in its own process, route handed-off cars between them,
+# and restart a worker that crashed with the cars it held at the time
+class Supervisor:
+    def __init__(self, config, metrics_port=None, restart_delay=2.0):
+        self.intersections = {intersection['name']: intersection for intersection in config['intersections']}
+        self.all_cars = all_car_configs(config)
+        self.metrics_port = metrics_port
+        self.restart_delay = restart_delay
+
+        # which intersection holds each car, updated on every handoff
+        self.car_configs = {car['id']: dict(car) for car in self.all_cars}
+        self.holders = {car['id']: intersection['name'] for intersection in config['intersections'] for car in intersection.get('cars', [])}
+
+        # the model's thread pool is split between the workers
+        self.threads = max(1, available_cores() // len(self.intersections))
+
+        self.context = multiprocessing.get_context('spawn')
+        self.outbox = self.context.Queue()
+        self.inboxes = {name: self.context.Queue() for name in self.intersections}
+        self.processes = {}
+        self.restarts = {name: 0 for name in self.intersections}
+        self.handoffs = 0
+        self.running = False
+
+    def start_worker(self, name):
+        cars = [self.car_configs[car_id] for car_id in self.holders if self.holders[car_id] == name]
+        names = list(self.intersections)
+        port = self.metrics_port + names.index(name) if self.metrics_port is not None else None
+        process = self.context.Process(target=run_worker, name=f'intersection-{name}',
+                                       args=(self.intersections[name], self.all_cars, cars, self.inboxes[name], self.outbox, self.threads, port))
+        process.daemon = True
+        process.start()
+        self.processes[name] = process
+        print(f'Started intersection "{name}" (pid {process.pid}) with {len(cars)} cars')
+
+    def handoff(self, source, handoff):
+        car_id = handoff['car']['id']
+        target = handoff['to']
+        self.handoffs += 1
+        if target not in self.inboxes:
+            print(f'"{car_id}" left the deployment from "{source}"')
+            self.holders.pop(car_id, None)
+            return
+        self.holders[car_id] = target
+        self.car_configs[car_id]['direction'] = handoff['direction']
+        self.inboxes[target].put(handoff)
+
+    def run(self):
+        self.running = True
+        for name in self.intersections:
+            self.start_worker(name)
+
+        while self.running:
+            try:
+                kind, source, message = self.outbox.get(timeout=0.5)
+                if kind == 'handoff':
+                    self.handoff(source, message)
+            except queue.Empty:
+                pass
+
+            for name, process in list(self.processes.items()):
+                if process.is_alive():
+                    continue
+                # a clean exit means the camera ran out, anything else is restarted
+                if process.exitcode == 0:
+                    print(f'Intersection "{name}" finished')
+                    del self.processes[name]
+                    continue
+                print(f'Intersection "{name}" exited with code {process.exitcode}, restarting in {self.restart_delay:.1f} s')
+                time.sleep(self.restart_delay)
+                self.restarts[name] += 1
+                self.start_worker(name)
+
+            if len(self.processes) == 0:
+                self.running = False
+
+    def stop(self):
+        self.running = False
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=2.0)
+
+    def print_stats(self):
+        print(f'Handed off {self.handoffs} cars between {len(self.intersections)} intersections')
+        for name in self.intersections:
+            print(f'{name}: {self.restarts[name]} restarts, holding {sorted(car_id for car_id in self.holders if self.holders[car_id] == name)}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run every intersection of a config file in its own worker process.')
+    parser.add_argument('config', help='JSON file with an "intersections" list, see data/intersections.json')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve each worker\'s metrics from this port upwards')
+    parser.add_argument('--restart-delay', type=float, default=2.0, help='seconds to wait before restarting a crashed worker')
+    args = parser.parse_args()
+
+    supervisor = Supervisor(load_config(args.config), metrics_port=args.metrics_port, restart_delay=args.restart_delay)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        print('\n\nCtrl+C detected. Stopping intersections.')
+    supervisor.stop()
+    supervisor.print_stats()
@@ -0,0 +1,100 @@
+import threading
+import time
+import numpy
+
+# column layout of every telemetry row
+FIELDS = ('time', 'greyscale_0', 'greyscale_1', 'greyscale_2', 'speed', 'mileage', 'sonar_angle', 'sonar_distance')
+COLUMNS = {field: index for index, field in enumerate(FIELDS)}
+
+# fixed-capacity, preallocated ring buffer of a vehicle's timestamped telemetry, optionally memory-mapped to a .npy
+# file so the history survives the run, appending only writes into the existing array
+class TelemetryRing:
+    def __init__(self, capacity=4096, path=None):
+        self.capacity = capacity
+        self.path = path
+        if path is None:
+            self.data = numpy.zeros((capacity, len(FIELDS)), dtype=numpy.float64)
+        else:
+            self.data = numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.float64, shape=(capacity, len(FIELDS)))
+        self.count = 0
+
+        # written from the websocket thread, queried from the control thread
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, greyscale, speed, mileage, sonar_angle, sonar_distance, timestamp=None):
+        with self.lock:
+            row = self.data[self.count % self.capacity]
+            row[0] = time.monotonic() if timestamp is None else timestamp
+            row[1] = greyscale[0]
+            row[2] = greyscale[1]
+            row[3] = greyscale[2]
+            row[4] = speed
+            row[5] = mileage
+            row[6] = sonar_angle
+            row[7] = sonar_distance
+            self.count += 1
+
+    # the last n rows (all rows if n is None) in time order, as a copy
+    def latest(self, n=None):
+        with self.lock:
+            size = len(self)
+            n = size if n is None else min(n, size)
+            end = self.count % self.capacity
+            if n <= end:
+                return self.data[end - n:end].copy()
+            return numpy.concatenate((self.data[self.capacity - (n - end):], self.data[:end]))
+
+    # rows received in the last `seconds` seconds, in time order
+    def window(self, seconds, now=None):
+        rows = self.latest()
+        now = time.monotonic() if now is None else now
+        return rows[numpy.searchsorted(rows[:, 0], now - seconds):]
+
+    def column(self, field, seconds=None):
+        rows = self.latest() if seconds is None else self.window(seconds)
+        return rows[:, COLUMNS[field]]
+
+    # rolling mean or min of a field over windows of n consecutive samples
+    def rolling(self, field, n, statistic='mean'):
+        values = self.column(field)
+        if len(values) < n:
+            return numpy.zeros(0)
+        windows = numpy.lib.stride_tricks.sliding_window_view(values, n)
+        if statistic == 'mean':
+            return windows.mean(axis=1)
+        elif statistic == 'min':
+            return windows.min(axis=1)
+        raise ValueError('statistic must be "mean" or "min"')
+
+    # mean and min sonar distance over the last `seconds` seconds
+    def sonar_summary(self, seconds):
+        distances = self.column('sonar_distance', seconds)
+        if len(distances) == 0:
+            return None, None
+        return float(distances.mean()), float(distances.min())
+
+    # speed change per second at every sample of the last `seconds` seconds
+    def speed_derivative(self, seconds=None):
+        rows = self.latest() if seconds is None else self.window(seconds)
+        if len(rows) < 2:
+            return numpy.zeros(len(rows))
+        times = rows[:, 0]
+        # samples sharing a timestamp would divide by zero
+        keep = numpy.concatenate(([True], numpy.diff(times) > 0))
+        if keep.sum() < 2:
+            return numpy.zeros(keep.sum())
+        return numpy.gradient(rows[keep, 4], times[keep])
+
+    def flush(self):
+        if self.path is not None:
+            self.data.flush()
+
+    # read a memory-mapped history back for analysis, in time order without the unwritten rows
+    @staticmethod
+    def load(path):
+        data = numpy.load(path, mmap_mode='r')
+        rows = numpy.array(data[data[:, 0] > 0])
+        return rows[numpy.argsort(rows[:, 0], kind='stable')]
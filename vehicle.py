@@ -20,6 +20,8 @@ class Vehicle:
         self.RIGHT_PATH = [1, 0.13, 1, 0.13]
         self.turning = False
         self.LEFT_PATH = [0.35, 1, 0.35, 1]
+        # telemetry history, a TelemetryRing when the vehicle is connected to a real car
+        self.telemetry = None
 
     # map a direction to the motor speeds the car will need to have to complete that maneuver 
     def direction_to_motor_power(self, car_turns, speed):
@@ -1,33 +1,120 @@
 import cv2
+import sys
 import threading
-import queue
+import time
+import numpy
+from metrics import metrics
+
+# DirectShow only exists on Windows, let OpenCV pick the backend everywhere else
+DEFAULT_BACKEND = cv2.CAP_DSHOW if sys.platform == 'win32' else cv2.CAP_ANY
 
 class VideoCapture:
 
-  def __init__(self, name):
-    self.cap = cv2.VideoCapture(name, cv2.CAP_DSHOW)
-    
-    self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
-    self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
-    self.cap.set(cv2.CAP_PROP_FPS, 30)
-    
-    self.q = queue.Queue()
+  def __init__(self, name, width=1920, height=1080, fps=30, backend=None, output_size=(640, 640), buffers=3):
+    self.cap = cv2.VideoCapture(name, DEFAULT_BACKEND if backend is None else backend)
+
+    self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    self.cap.set(cv2.CAP_PROP_FPS, fps)
+
+    # frames are resized on the capture thread into a small pool of reused buffers, one holds the newest
+    # frame, one was handed to the reader, any number are held by consumers until release_frame, and the
+    # capture thread writes into a free one, adding a buffer when every one is in use
+    self.output_size = output_size
+    self.raw = None
+    self.buffers = [numpy.empty((output_size[1], output_size[0], 3), dtype=numpy.uint8) for _ in range(max(buffers, 3))]
+    self.holds = [0] * len(self.buffers)
+    self.latest = None
+    self.reading = None
+
+    # single "latest frame" slot
+    self.condition = threading.Condition()
+    self.sequence = 0
+    self.timestamp = 0.0
+    self.read_sequence = 0
+    self.dropped = 0
+    self.duplicates = 0
+    self.running = True
+
     t = threading.Thread(target=self._reader)
     t.daemon = True
     t.start()
 
   # read frames as soon as they are available, keeping only most recent one
   def _reader(self):
-    while True:
-      ret, frame = self.cap.read()
+    while self.running:
+      start = time.perf_counter()
+      ret, raw = self.cap.read(self.raw)
       if not ret:
         break
-      if not self.q.empty():
-        try:
-          self.q.get_nowait()   # discard previous (unprocessed) frame
-        except queue.Empty:
-          pass
-      self.q.put(frame)
-
-  def read(self):
-    return self.q.get()
\ No newline at end of file
+      metrics.since('capture', start)
+      self.raw = raw
+      timestamp = time.monotonic()
+
+      with self.condition:
+        target = next((index for index in range(len(self.buffers)) if index != self.latest and index != self.reading and self.holds[index] == 0), None)
+        if target is None:
+          target = len(self.buffers)
+          self.buffers.append(numpy.empty_like(self.buffers[0]))
+          self.holds.append(0)
+      start = time.perf_counter()
+      cv2.resize(raw, self.output_size, dst=self.buffers[target])
+      metrics.since('resize', start)
+
+      with self.condition:
+        # the previous frame was replaced before anyone read it
+        if self.sequence > self.read_sequence:
+          self.dropped += 1
+        self.latest = target
+        self.sequence += 1
+        self.timestamp = timestamp
+        self.condition.notify_all()
+
+    with self.condition:
+      self.running = False
+      self.condition.notify_all()
+
+  # return (frame, sequence, capture timestamp on the time.monotonic clock), waiting for a frame newer than the last
+  # one read when wait is True, frame is None once the camera stops, the frame stays valid until the next read
+  # unless copy is True, or until it is handed back to release_frame when hold is True
+  def read_latest(self, wait=True, copy=False, hold=False):
+    with self.condition:
+      if wait:
+        self.condition.wait_for(lambda: self.sequence > self.read_sequence or not self.running)
+      if self.latest is None or (wait and self.sequence == self.read_sequence):
+        return None, self.sequence, self.timestamp
+      if self.sequence == self.read_sequence:
+        self.duplicates += 1
+      self.reading = self.latest
+      self.read_sequence = self.sequence
+      frame = self.buffers[self.reading]
+      if hold and not copy:
+        self.holds[self.reading] += 1
+      return (frame.copy() if copy else frame), self.sequence, self.timestamp
+
+  def read(self, copy=False):
+    return self.read_latest(copy=copy)[0]
+
+  # (frame, capture timestamp) for consumers that measure latency from the moment of capture
+  def read_timestamped(self, copy=False, hold=False):
+    frame, _, timestamp = self.read_latest(copy=copy, hold=hold)
+    return frame, timestamp
+
+  # hand back a frame read with hold=True so the capture thread may reuse its buffer, other arrays are ignored
+  def release_frame(self, frame):
+    with self.condition:
+      for index, buffer in enumerate(self.buffers):
+        if buffer is frame and self.holds[index] > 0:
+          self.holds[index] -= 1
+          return
+
+  def release(self):
+    self.running = False
+    self.cap.release()
+
+  def stats(self):
+    return {'frames': self.sequence, 'read': self.read_sequence, 'dropped': self.dropped, 'duplicates': self.duplicates, 'buffers': len(self.buffers)}
+
+  def print_stats(self):
+    stats = self.stats()
+    print(f'Camera captured {stats["frames"]} frames, dropped {stats["dropped"]}, re-read {stats["duplicates"]}, into {stats["buffers"]} buffers')